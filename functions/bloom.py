@@ -0,0 +1,31 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter over strings. `in` never gives a false
+    negative, and gives a false positive with probability around
+    `errorRate` while fewer than `capacity` items have been added.
+    """
+
+    def __init__(self, capacity=1000000, errorRate=0.01):
+        self.size = max(8, math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, item):
+        # Double hashing (Kirsch-Mitzenmacher) from one 128 bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for i in self.__positions(item):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self.__positions(item))
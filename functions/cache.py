@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+CachedSubmission = namedtuple("CachedSubmission", ["author", "subreddit"])
+
+
+class TableCache:
+    """
+    Bounded in-memory LRU in front of a table in the build database, so
+    entries are shared between users, layers and runs. Safe to use from
+    fetch workers.
+    """
+
+    table = None
+    key = "key"
+    columns = ()
+
+    def __init__(self, path, capacity=100000):
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                {self.key} TEXT PRIMARY KEY,
+                {", ".join(f"{name} {kind}" for name, kind in self.columns)}
+            )
+            """
+        )
+        self.conn.commit()
+
+    def _valid(self, value):
+        return True
+
+    def __remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            missing = []
+            for i in keys:
+                if i in self.memory and self._valid(self.memory[i]):
+                    self.memory.move_to_end(i)
+                    found[i] = self.memory[i]
+                else:
+                    missing.append(i)
+
+            if missing:
+                rows = self.conn.execute(
+                    "SELECT {0}, {1} FROM {2} WHERE {0} IN ({3})".format(
+                        self.key,
+                        ", ".join(name for name, _ in self.columns),
+                        self.table,
+                        ", ".join("?" * len(missing)),
+                    ),
+                    missing,
+                ).fetchall()
+                for key, *value in rows:
+                    value = tuple(value)
+                    if self._valid(value):
+                        found[key] = value
+                        self.__remember(key, value)
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, rows):
+        rows = list(rows)
+        with self.lock:
+            for key, *value in rows:
+                self.__remember(key, tuple(value))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO {} VALUES ({})".format(
+                    self.table, ", ".join("?" * (len(self.columns) + 1))
+                ),
+                rows,
+            )
+            self.conn.commit()
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits, self.misses = 0, 0
+
+    def close(self):
+        self.conn.close()
+
+
+class SubmissionCache(TableCache):
+    """Submission fullname -> (author, subreddit) names"""
+
+    table = "submissions"
+    key = "fullname"
+    columns = (("author", "TEXT"), ("subreddit", "TEXT"))
+
+
+class SubredditCache(TableCache):
+    """
+    Subreddit name -> (over18, subscribers, fetchedAt). User profiles are
+    stored under their profile subreddit (u_username).
+    """
+
+    table = "subreddits"
+    key = "name"
+    columns = (
+        ("over18", "INTEGER"),
+        ("subscribers", "INTEGER"),
+        ("fetchedAt", "REAL"),
+    )
+
+    def __init__(self, path, capacity=100000, maxAge=86400):
+        self.maxAge = maxAge
+        super().__init__(path, capacity=capacity)
+
+    def _valid(self, value):
+        return time.time() - value[2] < self.maxAge
+
+    def put_many(self, rows):
+        now = time.time()
+        super().put_many(
+            (name.lower(), int(over18), subscribers, now)
+            for name, over18, subscribers in rows
+        )
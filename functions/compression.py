@@ -0,0 +1,88 @@
+class BodyCodec:
+    """
+    zstd compression of comment bodies, one frame per body so rows stay
+    individually readable. Short texts like comments compress poorly on
+    their own, so once `trainSamples` bodies have been seen a dictionary
+    is trained from them and used for every later body. The dictionary is
+    stored in the database's meta table. Requires zstandard.
+    """
+
+    def __init__(self, level=9, trainSamples=2000, dictSize=112640):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Compressed storage requires zstandard (pip install zstandard)"
+            ) from None
+
+        self.zstd = zstandard
+        self.level = level
+        self.trainSamples = trainSamples
+        self.dictSize = dictSize
+
+        self.samples = []
+        self.dictionary = None
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.plain = zstandard.ZstdDecompressor()
+        self.decompressor = None
+
+        self.rawBytes = 0
+        self.storedBytes = 0
+
+    def __use_dictionary(self, data):
+        self.dictionary = self.zstd.ZstdCompressionDict(data)
+        self.compressor = self.zstd.ZstdCompressor(
+            level=self.level, dict_data=self.dictionary
+        )
+        self.decompressor = self.zstd.ZstdDecompressor(dict_data=self.dictionary)
+
+    def load(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'zstd_dict'").fetchone()
+        if row is not None:
+            self.__use_dictionary(row[0])
+
+    def __train(self, conn):
+        try:
+            trained = self.zstd.train_dictionary(self.dictSize, self.samples)
+        except self.zstd.ZstdError:
+            # Not enough distinct data to train from yet
+            return
+        finally:
+            self.samples = []
+        self.__use_dictionary(trained.as_bytes())
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('zstd_dict', ?)",
+            (self.dictionary.as_bytes(),),
+        )
+
+    def encode_rows(self, conn, rows):
+        """
+        Compress the comment (second column) of every row. Called from the
+        writer's transaction, so a newly trained dictionary is committed
+        together with the first rows using it.
+        """
+        if self.dictionary is None:
+            self.samples.extend(i[1].encode("utf-8") for i in rows)
+            if len(self.samples) >= self.trainSamples:
+                self.__train(conn)
+
+        encoded = []
+        for id, comment, *rest in rows:
+            raw = comment.encode("utf-8")
+            body = self.compressor.compress(raw)
+            self.rawBytes += len(raw)
+            self.storedBytes += len(body)
+            encoded.append((id, body, *rest))
+        return encoded
+
+    def decode(self, body):
+        if not isinstance(body, bytes):
+            return body
+        # Bodies written before the dictionary was trained have no dict id
+        if self.decompressor is not None and self.zstd.get_frame_parameters(body).dict_id:
+            return self.decompressor.decompress(body).decode("utf-8")
+        return self.plain.decompress(body).decode("utf-8")
+
+    def ratio(self):
+        return self.rawBytes / self.storedBytes if self.storedBytes else 1.0
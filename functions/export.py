@@ -0,0 +1,58 @@
+class ParquetExport:
+    """
+    Write dump rows to a Parquet file one row group at a time, so memory
+    stays bounded by `rowGroupSize`. Requires pyarrow.
+    """
+
+    def __init__(self, path, normalized=False, rowGroupSize=100000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                "Parquet export requires pyarrow (pip install pyarrow)"
+            ) from None
+
+        self.pa = pa
+        self.path = path
+        self.rowGroupSize = rowGroupSize
+        self.schema = pa.schema(
+            [
+                ("id", pa.int64()),
+                ("comment", pa.string()),
+                ("score", pa.float64() if normalized else pa.int64()),
+            ]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.pending = []
+        self.rows = 0
+
+    def write(self, rows):
+        """
+        Parameters:
+            rows    (iterable)  (id, comment, score), ...
+        """
+        self.pending.extend(rows)
+        while len(self.pending) >= self.rowGroupSize:
+            self.__write_group(self.pending[: self.rowGroupSize])
+            del self.pending[: self.rowGroupSize]
+
+    def __write_group(self, rows):
+        ids, comments, scores = zip(*rows)
+        self.writer.write_table(
+            self.pa.Table.from_arrays(
+                [
+                    self.pa.array(ids, self.schema.field("id").type),
+                    self.pa.array(comments, self.schema.field("comment").type),
+                    self.pa.array(scores, self.schema.field("score").type),
+                ],
+                schema=self.schema,
+            )
+        )
+        self.rows += len(rows)
+
+    def close(self):
+        if self.pending:
+            self.__write_group(self.pending)
+            self.pending = []
+        self.writer.close()
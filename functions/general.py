@@ -1,8 +1,27 @@
 import os
+import re
 from colorama import Fore, Style
 import datetime
 
 
+def get_credentials():
+    """
+    OAuth apps configured in the environment (.env): client_id and
+    client_secret, then client_id_N and client_secret_N for every
+    further app, in order of N
+
+    Returns:
+        (list)  [(clientID (str), clientSecret (str)), ...]
+    """
+    numbered = sorted(
+        int(i[len("client_id_") :]) for i in os.environ if re.fullmatch(r"client_id_\d+", i)
+    )
+    pairs = [(os.getenv("client_id"), os.getenv("client_secret"))] + [
+        (os.getenv(f"client_id_{i}"), os.getenv(f"client_secret_{i}")) for i in numbered
+    ]
+    return [(id, secret) for id, secret in pairs if id and secret]
+
+
 def normalize_range(x, _max=1000, _min=--1000, clamp=True):
     if clamp:
         if x > _max:
@@ -1,29 +1,64 @@
 import sqlite3
 import os
+import gzip
+import glob
+import time
 from pathlib import Path
 from functions.general import _human_bytes
-from random import randint
+from functions.writer import BulkWriter, ShardedWriter
+from functions.bloom import BloomFilter
+from functions.export import ParquetExport
+from functions.compression import BodyCodec
 import json
+from collections import Counter
 
 
 class LayerHandling:
-    def __init__(self, logger, dir):
+    # Caches shared between runs, kept when the build database is cleared
+    persistentTables = ("submissions", "subreddits")
+
+    def __init__(self, logger, dir, visitedCapacity=1000000, shared=False):
+        """
+        Parameters:
+            shared  (bool)  [False] build/layers.db is written by several
+                                    processes (distributed crawl)
+        """
         self.logger = logger
+        self.visitedCapacity = visitedCapacity
+        self.shared = shared
+        self.skippedUsers = 0
         self.mainPath = dir
         self.buildPath = os.path.join(self.mainPath, "build")
         Path(self.buildPath).mkdir(exist_ok=True)
 
         self.buildDb = os.path.join(self.buildPath, "layers.db")
         self.dumpDb = os.path.join(self.mainPath, "dump.db")
+        self.parquetPath = os.path.join(self.mainPath, "dump.parquet")
+        self.writer = None
+        self.normalized = False
+        self.codec = None
+        self.shards = 1
+        self.synchronous = "NORMAL"  # As configured for the writer
 
     """
     Dump database
     """
 
+    def shard_path(self, shard):
+        return os.path.join(self.mainPath, f"dump-{shard}.db")
+
+    def worker_path(self, worker):
+        return os.path.join(self.mainPath, f"dump-w{worker}.db")
+
+    def find_shards(self):
+        return sorted(glob.glob(os.path.join(self.mainPath, "dump-*.db")))
+
     def clear_dump_db(self):
         if os.path.isfile(self.dumpDb):
             self.logger.warning("dump.db already exists")
             os.remove(self.dumpDb)
+        for path in self.find_shards():
+            os.remove(path)
         self.logger.debug("Cleared dump database")
 
     def establish_dump_db(self):
@@ -31,111 +66,568 @@ class LayerHandling:
         self.dumpCurs = self.dumpConn.cursor()
         self.logger.debug("Setup dump database")
 
-    def setup_dump_table(self, normalize):
+    def setup_dump_table(self, normalize, compress=False, shards=1):
         # Unsafe but safety is not necesssary
-        scoreType = "REAL" if normalize["normalize"] else "INTEGER"
-        query = f"""CREATE TABLE data (
+        self.normalized = normalize["normalize"]
+        self.shards = shards
+        scoreType = "REAL" if self.normalized else "INTEGER"
+        # id is the reddit comment id (base 36 decoded), so a comment scraped
+        # again in a later layer is ignored on insert
+        self.dumpSchema = f"""CREATE TABLE IF NOT EXISTS data (
             id INTEGER PRIMARY KEY,
-            comment TEXT,
+            comment {"BLOB" if compress else "TEXT"},
             score {scoreType}
         )
         """
-        self.dumpCurs.execute(query)
+        self.dumpCurs.execute(self.dumpSchema)
+        if shards > 1:
+            for i in range(shards):
+                self.__create_shard(self.shard_path(i))
+        if compress:
+            self.codec = BodyCodec()
+            self.codec.load(self.dumpConn)
+        else:
+            # A resumed dump that was started with compressBodies stays
+            # compressed
+            self.load_codec()
         self.dumpConn.commit()
         self.logger.debug(f"Setup dump table {'(normalized)' if normalize else ''}")
 
-    def dump_data(self, comments):
-        self.logger.debug(f"Inserting {len(comments)} comments into dump.db..")
-        data = tuple(
-            [(randint(1, 9999999999), i["comment"], i["score"]) for i in comments]
-        )
+    def __create_shard(self, path):
+        conn = sqlite3.connect(path)
+        conn.execute(self.dumpSchema)
+        conn.commit()
+        conn.close()
 
-        chunkID = 0
-        for chunk in self.__get_chunks(data, 5):
-            chunkID += 1
-            self.logger.debug(f"Inserting chunk {chunkID}: {len(chunk)}")
-            self.logger.debug(json.dumps(chunk, indent=2))
-            self.dumpCurs.executemany(
+    def start_writer(self, parquet=False, path=None, **kwargs):
+        """
+        Start the background writer for dump.db (see BulkWriter for kwargs)
+
+        Parameters:
+            parquet     (bool)      [False]     Also write every new row to
+                                                dump.parquet as it is stored
+            path        (str/None)  [None]      Write to this shard instead
+                                                (a worker's dump-wN.db)
+        """
+        self.synchronous = kwargs.get("synchronous", self.synchronous)
+        if path is not None:
+            self.__create_shard(path)
+            self.writer = BulkWriter(
+                path,
                 "INSERT OR IGNORE INTO data (id, comment, score) VALUES (?, ?, ?)",
-                chunk,
+                **kwargs,
+            )
+            self.logger.debug(f"Started dump writer for {os.path.basename(path)}")
+            return
+
+        if self.shards > 1:
+            # Each shard file has its own lock, so shards commit in parallel
+            self.writer = ShardedWriter(
+                [self.shard_path(i) for i in range(self.shards)],
+                "INSERT OR IGNORE INTO data (id, comment, score) VALUES (?, ?, ?)",
+                **kwargs,
             )
-            self.logger.debug(
-                f"Inserted chunk {chunkID}: {len(chunk) * chunkID}/{len(data)}"
+            self.logger.debug(f"Started {self.shards} sharded dump writers")
+            return
+
+        sinks = [ParquetExport(self.parquetPath, self.normalized)] if parquet else []
+        self.writer = BulkWriter(
+            self.dumpDb,
+            "INSERT OR IGNORE INTO data (id, comment, score) VALUES (?, ?, ?)",
+            sinks=sinks,
+            existingQuery="SELECT id FROM data WHERE id IN ({})",
+            encode=self.codec.encode_rows if self.codec is not None else None,
+            **kwargs,
+        )
+        self.logger.debug("Started dump writer")
+
+    def flush_writer(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.logger.debug("Closed dump writer")
+
+    def merge_shards(self, paths=None, group=8):
+        """
+        Move every row of the shard databases into dump.db in one bulk
+        pass (duplicates are ignored), then delete the shards
+
+        Parameters:
+            paths   (list/None) [None]  Shard files (all dump-*.db if None)
+            group   (int)       [8]     Shards attached per statement
+
+        Returns:
+            (int) Rows added to dump.db
+        """
+        self.close_writer()
+        paths = self.find_shards() if paths is None else paths
+        start = time.time()
+        merged = 0
+        self.dumpConn.execute("PRAGMA synchronous = OFF")
+        for i in range(0, len(paths), group):
+            chunk = paths[i : i + group]
+            for j, path in enumerate(chunk):
+                self.dumpConn.execute(f"ATTACH DATABASE ? AS shard{j}", (path,))
+            union = " UNION ALL ".join(
+                f"SELECT id, comment, score FROM shard{j}.data" for j in range(len(chunk))
             )
-            self.dumpConn.commit()
-            self.logger.debug(f"Committed to database")
-        self.logger.debug(f"Inserted {len(comments)} rows into dump.db")
-
-    def __get_chunks(self, data, n):
-        for i in range(0, len(data), n):
-            yield data[i : i + n]
-
-    def __get_dump(self):
-        self.dumpCurs.execute("SELECT * FROM data")
-        return self.dumpCurs.fetchall()
-
-    def __get_json_dump(self):
-        data = self.__get_dump()
-        return [
-            {
-                "comment": i[1],
-                "score": i[2],
-            }
-            for i in data
-        ]
-
-    def json_dump(self):
-        data = self.__get_json_dump()
-        json.dump(
-            data,
-            open(os.path.join(self.mainPath, "dump.json"), "w"),
-            indent=2,
+            # Inserting in id order appends to the id b-tree instead of
+            # splitting pages all over it
+            with self.dumpConn:
+                # rowcount leaves out rows written by triggers (full-text index)
+                merged += self.dumpConn.execute(
+                    f"INSERT OR IGNORE INTO data (id, comment, score) SELECT * FROM ({union}) ORDER BY id"
+                ).rowcount
+            for j in range(len(chunk)):
+                self.dumpConn.execute(f"DETACH DATABASE shard{j}")
+        self.dumpConn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        for path in paths:
+            os.remove(path)
+            for suffix in ("-wal", "-shm"):
+                if os.path.isfile(path + suffix):
+                    os.remove(path + suffix)
+
+        self.logger.debug(
+            f"Merged {len(paths)} shards ({merged} rows) in {round(time.time() - start, 2)}s"
         )
+        return merged
+
+    def setup_fts(self, live=True):
+        """
+        Create the full-text index over comment bodies (data_fts). It only
+        stores the index, so matches are joined back to data by id.
+
+        Parameters:
+            live    (bool)  [True]  Index rows as they are inserted (a
+                                    trigger on data). Not possible for
+                                    compressed bodies, use build_fts then
+        """
+        self.dumpConn.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS data_fts USING fts5(
+                comment, content='', tokenize='unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        if live:
+            self.dumpConn.execute(
+                """CREATE TRIGGER IF NOT EXISTS data_fts_insert AFTER INSERT ON data
+                BEGIN
+                    INSERT INTO data_fts (rowid, comment) VALUES (new.id, new.comment);
+                END
+                """
+            )
+        self.dumpConn.commit()
+        self.logger.debug(f"Setup full-text index {'(live)' if live else ''}")
+
+    def has_fts(self):
+        self.dumpCurs.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'data_fts'"
+        )
+        return self.dumpCurs.fetchone() is not None
+
+    def build_fts(self, batchSize=5000):
+        """
+        (Re)build the full-text index from every row of dump.db in one pass
+
+        Returns:
+            (int) Rows indexed
+        """
+        self.flush_writer()
+        self.dumpConn.execute("DROP TRIGGER IF EXISTS data_fts_insert")
+        self.dumpConn.execute("DROP TABLE IF EXISTS data_fts")
+        self.setup_fts(live=False)
+
+        rows = 0
+        batch = []
+        with self.dumpConn:
+            for id, comment, _ in self.iter_dump(batchSize):
+                batch.append((id, comment))
+                if len(batch) >= batchSize:
+                    self.dumpConn.executemany(
+                        "INSERT INTO data_fts (rowid, comment) VALUES (?, ?)", batch
+                    )
+                    rows += len(batch)
+                    batch = []
+            self.dumpConn.executemany(
+                "INSERT INTO data_fts (rowid, comment) VALUES (?, ?)", batch
+            )
+            rows += len(batch)
+            # Merge the index segments written by the bulk insert
+            self.dumpConn.execute("INSERT INTO data_fts (data_fts) VALUES ('optimize')")
+        self.logger.debug(f"Indexed {rows} comments")
+        return rows
+
+    def load_codec(self):
+        """Set up decompression if dump.db stores compressed bodies"""
+        self.dumpCurs.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meta'"
+        )
+        if self.codec is None and self.dumpCurs.fetchone() is not None:
+            self.codec = BodyCodec()
+            self.codec.load(self.dumpConn)
+
+    def search(self, query, limit=20):
+        """
+        Full-text search of comment bodies, best matches first
+
+        Parameters:
+            query   (str)           FTS5 query (words, "phrases", AND/OR/NOT, prefix*)
+            limit   (int)   [20]    Max results
+
+        Returns:
+            (list) [(id (int), comment (str), score (int/float)), ...]
+        """
+        self.flush_writer()
+        rows = self.dumpConn.execute(
+            """SELECT data.id, data.comment, data.score FROM data_fts
+            JOIN data ON data.id = data_fts.rowid
+            WHERE data_fts MATCH ? ORDER BY data_fts.rank LIMIT ?""",
+            (query, limit),
+        ).fetchall()
+        if self.codec is not None:
+            rows = [(id, self.codec.decode(comment), score) for id, comment, score in rows]
+        return rows
+
+    def dedupe_dump(self, nearDuplicates, batchSize=5000):
+        """
+        Delete near-duplicate comments from dump.db (the first copy by id
+        is kept), then rebuild the full-text index if there is one
+
+        Parameters:
+            nearDuplicates  (NearDuplicateFilter)
+
+        Returns:
+            (int) Rows deleted
+        """
+        deleted = 0
+        batch = []
+        for id, comment, _ in self.iter_dump(batchSize):
+            if nearDuplicates.is_duplicate(comment):
+                batch.append((id,))
+            if len(batch) >= batchSize:
+                # Rows before the keyset cursor can be deleted while iterating
+                with self.dumpConn:
+                    self.dumpConn.executemany("DELETE FROM data WHERE id = ?", batch)
+                deleted += len(batch)
+                batch = []
+        with self.dumpConn:
+            self.dumpConn.executemany("DELETE FROM data WHERE id = ?", batch)
+        deleted += len(batch)
+
+        if self.has_fts():
+            # Rows can't be removed from a contentless index
+            self.build_fts()
+        # Give the space back
+        self.dumpConn.execute("VACUUM")
+        return deleted
+
+    def dump_data(self, comments):
+        data = [(i["id"], i["comment"], i["score"]) for i in comments]
+        self.writer.write(data)
+        self.logger.debug(f"Queued {len(data)} rows for dump.db")
+
+    def iter_dump(self, batchSize=5000):
+        """
+        Stream every row of dump.db in id order, `batchSize` rows per query
+
+        Returns:
+            (generator) (id (int), comment (str), score (int/float)), ...
+        """
+        self.flush_writer()
+        decode = self.codec.decode if self.codec is not None else None
+        lastID = -1  # Comment ids are never negative
+        while True:
+            rows = self.dumpConn.execute(
+                "SELECT id, comment, score FROM data WHERE id > ? ORDER BY id LIMIT ?",
+                (lastID, batchSize),
+            ).fetchall()
+            if not rows:
+                return
+            lastID = rows[-1][0]
+            if decode is not None:
+                rows = [(id, decode(comment), score) for id, comment, score in rows]
+            yield from rows
+
+    def parquet_dump(self, rowGroupSize=100000):
+        """
+        Export dump.db to dump.parquet, one row group at a time
+
+        Returns:
+            (int) Rows written
+        """
+        export = ParquetExport(self.parquetPath, self.normalized, rowGroupSize)
+        try:
+            batch = []
+            for row in self.iter_dump():
+                batch.append(row)
+                if len(batch) >= rowGroupSize:
+                    export.write(batch)
+                    batch = []
+            export.write(batch)
+        finally:
+            export.close()
+        return export.rows
+
+    def json_dump(self, format="json", compress=False):
+        """
+        Export dump.db without loading it into memory
+
+        Parameters:
+            format      (str)   ["json"]    "json" (one array) or "ndjson"
+                                            (one object per line)
+            compress    (bool)  [False]     gzip the output
+
+        Returns:
+            (str) Path written to
+        """
+        path = os.path.join(self.mainPath, f"dump.{format}")
+        if compress:
+            path += ".gz"
+            handle = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+        else:
+            handle = open(path, "w", encoding="utf-8", buffering=1 << 20)
+
+        encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+        with handle:
+            if format == "ndjson":
+                for _, comment, score in self.iter_dump():
+                    handle.write(encode({"comment": comment, "score": score}))
+                    handle.write("\n")
+            else:
+                separator = "[\n"
+                for _, comment, score in self.iter_dump():
+                    handle.write(separator)
+                    handle.write(encode({"comment": comment, "score": score}))
+                    separator = ",\n"
+                handle.write("[]\n" if separator == "[\n" else "\n]\n")
+        return path
 
     """
     Build database
     """
 
-    def clear_build_db(self):
+    def clear_build_db(self, keepCaches=True):
         if os.path.isfile(self.buildDb):
-            os.remove(self.buildDb)
+            conn = sqlite3.connect(self.buildDb)
+            tables = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            for (table,) in tables:
+                if not keepCaches or table not in self.persistentTables:
+                    conn.execute(f"DROP TABLE {table}")
+            conn.commit()
+            conn.close()
         self.logger.debug("Cleared build database")
 
     def establish_build_db(self):
-        self.buildConn = sqlite3.connect(self.buildDb)
+        # Other processes may hold the write lock for a while
+        self.buildConn = sqlite3.connect(self.buildDb, timeout=120 if self.shared else 5)
         self.buildCurs = self.buildConn.cursor()
+
+        # Every user ever added to a layer, so nobody is scraped twice. The
+        # bloom filter answers most lookups for new users without a query.
+        self.buildCurs.execute(
+            "CREATE TABLE IF NOT EXISTS visited (username TEXT PRIMARY KEY)"
+        )
+        # Checkpoints for resuming: users whose data is stored, and stages
+        # (creation, whole layers) that are finished
+        self.buildCurs.execute(
+            """CREATE TABLE IF NOT EXISTS completed (
+                layer INTEGER,
+                username TEXT,
+                PRIMARY KEY (layer, username)
+            )
+            """
+        )
+        self.buildCurs.execute(
+            "CREATE TABLE IF NOT EXISTS stages (name TEXT PRIMARY KEY)"
+        )
+        self.buildConn.commit()
+        if self.shared:
+            # Other processes add users the filter would never hear of
+            self.visited = None
+        else:
+            self.visited = BloomFilter(self.visitedCapacity)
+            for (username,) in self.buildCurs.execute("SELECT username FROM visited"):
+                self.visited.add(username)
         self.logger.debug("Setup build database")
 
+    def __unvisited(self, usernames):
+        """
+        Filter usernames (lowercase, unique) down to those not yet visited
+        """
+        if self.visited is None:
+            maybe = usernames
+        else:
+            maybe = [i for i in usernames if i in self.visited]
+        seen = set()
+        for i in range(0, len(maybe), 500):
+            chunk = maybe[i : i + 500]
+            self.buildCurs.execute(
+                f"SELECT username FROM visited WHERE username IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            seen.update(j[0] for j in self.buildCurs.fetchall())
+        return [i for i in usernames if i not in seen]
+
+    def checkpoint(self, layer, usernames):
+        """
+        Mark users of a layer as finished, once everything queued for them
+        has been written to dump.db
+        """
+        self.flush_writer()
+        self.buildCurs.executemany(
+            "INSERT OR IGNORE INTO completed (layer, username) VALUES (?, ?)",
+            ((layer, i) for i in usernames),
+        )
+        self.buildConn.commit()
+        self.logger.debug(f"Checkpointed {len(usernames)} users of layer{layer}")
+
+    def finish_stage(self, name):
+        self.flush_writer()
+        self.buildCurs.execute("INSERT OR IGNORE INTO stages (name) VALUES (?)", (name,))
+        self.buildConn.commit()
+
+    def stage_finished(self, name):
+        self.buildCurs.execute("SELECT 1 FROM stages WHERE name = ?", (name,))
+        return self.buildCurs.fetchone() is not None
+
+    def count_completed(self, layer):
+        self.buildCurs.execute("SELECT COUNT(*) FROM completed WHERE layer = ?", (layer,))
+        return self.buildCurs.fetchone()[0]
+
     def setup_build_layer(self, layer):
         # Unsafe but safety is not necesssary
         tableName = f"layer{layer}"
+        # refs counts how often the user was collected while the layer was
+        # built (comments replied to, submissions commented on), a cheap
+        # predictor of how much they post
         self.buildCurs.execute(
-            f"""CREATE TABLE {tableName} (
+            f"""CREATE TABLE IF NOT EXISTS {tableName} (
                 id TEXT,
-                username TEXT
+                username TEXT,
+                refs INTEGER DEFAULT 1
             )
             """
         )
+        self.buildCurs.execute(
+            f"CREATE INDEX IF NOT EXISTS {tableName}_username ON {tableName} (username)"
+        )
+        self.buildCurs.execute(
+            f"CREATE INDEX IF NOT EXISTS {tableName}_refs ON {tableName} (refs DESC)"
+        )
         self.buildConn.commit()
         self.logger.debug(f"Setup build layer {layer} -- {tableName}")
 
     def dump_build_layer(self, layer, users):
         tableName = f"layer{layer}"
         self.logger.debug(f"Inserting {len(users)} rows into {tableName}")
-        usernames = [("", i.name) for i in users if i is not None]
+        # Usernames are stored lowercase (reddit ignores their case), so a
+        # user seen with another casing still gains references
+        refs = Counter(i.name.lower() for i in users if i is not None)
+        if self.shared:
+            # Take the write lock before checking, so no other process adds
+            # the same users in between
+            self.buildCurs.execute("BEGIN IMMEDIATE")
+        new = self.__unvisited(list(refs))
+        self.skippedUsers += sum(refs.values()) - len(new)
+
+        if self.visited is not None:
+            for i in new:
+                self.visited.add(i)
+        self.buildCurs.executemany(
+            "INSERT OR IGNORE INTO visited (username) VALUES (?)",
+            ((i,) for i in new),
+        )
         self.buildCurs.executemany(
-            f"INSERT INTO {tableName} (id, username) VALUES (?, ?)",
-            usernames,
+            f"INSERT INTO {tableName} (id, username, refs) VALUES (?, ?, ?)",
+            (("", i, refs[i]) for i in new),
+        )
+        # Users queued before only gain references if they are still
+        # waiting in this layer
+        new = set(new)
+        self.buildCurs.executemany(
+            f"UPDATE {tableName} SET refs = refs + ? WHERE username = ?",
+            ((count, i) for i, count in refs.items() if i not in new),
         )
         self.buildConn.commit()
-        self.logger.debug(f"Dumped {len(usernames)} usernames to {tableName}")
+        self.logger.debug(f"Dumped {len(new)} usernames to {tableName}")
 
-    def read_build_layer(self, layer):
-        tableName = f"layer{layer}"
-        self.buildCurs.execute(f"SELECT username FROM {tableName}")
-        data = [i[0] for i in self.buildCurs.fetchall()]
-        self.logger.debug(f"Fetched {len(data)} usernames from {tableName}")
+    def read_build_layer(self, layer, limit=None):
+        data = list(self.iter_build_layer(layer, limit=limit, priority=False))
+        self.logger.debug(f"Fetched {len(data)} usernames from layer{layer}")
         return data
 
+    def iter_build_layer(
+        self, layer, limit=None, batchSize=1000, skipCompleted=False, priority=True
+    ):
+        """
+        Stream usernames from a layer, most referenced first (or in
+        insertion order), fetching `batchSize` rows per query. Pages are
+        keyed on (refs, rowid), so a limit takes the top users in SQL.
+
+        Parameters:
+            layer           (int)               Layer to read
+            limit           (int/None)  [None]  Max usernames to return
+            batchSize       (int)       [1000]  Rows per query
+            skipCompleted   (bool)      [False] Leave out checkpointed users
+                                                (they still count towards
+                                                the limit)
+            priority        (bool)      [True]  Most referenced users first,
+                                                otherwise insertion order
+
+        Returns:
+            (generator) username (str), ...
+        """
+        tableName = f"layer{layer}"
+        if priority:
+            order = "l.refs DESC, l.rowid"
+            after = "(l.refs < :refs OR (l.refs = :refs AND l.rowid > :rowid))"
+        else:
+            order = "l.rowid"
+            after = "l.rowid > :rowid"
+        cursor = None
+        while limit is None or limit > 0:
+            size = batchSize if limit is None else min(batchSize, limit)
+            rows = self.buildConn.execute(
+                f"""SELECT l.rowid, l.refs, l.username, EXISTS(
+                    SELECT 1 FROM completed c WHERE c.layer = :layer AND c.username = l.username
+                ) FROM {tableName} l
+                {"" if cursor is None else f"WHERE {after}"}
+                ORDER BY {order} LIMIT :size""",
+                {**(cursor or {}), "layer": layer, "size": size},
+            ).fetchall()
+            if not rows:
+                return
+            for _, _, username, done in rows:
+                if not (skipCompleted and done):
+                    yield username
+            cursor = {"rowid": rows[-1][0], "refs": rows[-1][1]}
+            if limit is not None:
+                limit -= len(rows)
+
+    def take_build_layer(self, layer, afterRowid=0, limit=100):
+        """
+        Read the next users added to a layer after `afterRowid`, for
+        crawling a layer while it is still being built
+
+        Returns:
+            (list) [(rowid (int), username (str), completed (bool)), ...]
+        """
+        return self.buildConn.execute(
+            f"""SELECT l.rowid, l.username, EXISTS(
+                SELECT 1 FROM completed c WHERE c.layer = ? AND c.username = l.username
+            ) FROM layer{layer} l WHERE l.rowid > ? ORDER BY l.rowid LIMIT ?""",
+            (layer, afterRowid, limit),
+        ).fetchall()
+
+    def count_build_layer(self, layer, limit=None):
+        (count,) = self.buildConn.execute(f"SELECT COUNT(*) FROM layer{layer}").fetchone()
+        return count if limit is None else min(count, limit)
+
     def get_size(self):
         return _human_bytes(os.path.getsize(os.path.join(self.mainPath, "data.db")))
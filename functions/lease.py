@@ -0,0 +1,158 @@
+import sqlite3
+import time
+
+
+class LeaseQueue:
+    """
+    Hands out the users of a layer to several crawler processes sharing
+    build/layers.db. Each call leases a batch for `leaseSeconds`; a batch
+    that is not completed in time (the process died) is leased again to
+    whoever asks next. Batches are taken from a shared cursor in frontier
+    order (most referenced first), so leasing never rescans the layer.
+    """
+
+    def __init__(self, path, worker, leaseSeconds=600, priority=True):
+        self.worker = str(worker)
+        self.leaseSeconds = leaseSeconds
+        self.priority = priority
+        # Only one process writes at a time, wait for the others
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS leases (
+                layer INTEGER,
+                username TEXT,
+                worker TEXT,
+                expires REAL,
+                done INTEGER DEFAULT 0,
+                PRIMARY KEY (layer, username)
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS leases_open ON leases (layer, done, expires)"
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS lease_cursors (
+                layer INTEGER PRIMARY KEY,
+                refs INTEGER,
+                rowid_ INTEGER,
+                taken INTEGER
+            )
+            """
+        )
+
+    def __next_rows(self, layer, cursor, size):
+        if self.priority:
+            order = "refs DESC, rowid"
+            after = "(refs < ? OR (refs = ? AND rowid > ?))"
+            params = (cursor[0], cursor[0], cursor[1])
+        else:
+            order = "rowid"
+            after = "rowid > ?"
+            params = (cursor[1],)
+        return self.conn.execute(
+            f"""SELECT rowid, refs, username, EXISTS(
+                SELECT 1 FROM completed c WHERE c.layer = ? AND c.username = l.username
+            ) FROM layer{layer} l
+            {"" if cursor[0] is None else f"WHERE {after}"}
+            ORDER BY {order} LIMIT ?""",
+            (layer, *(params if cursor[0] is not None else ()), size),
+        ).fetchall()
+
+    def lease(self, layer, size=50, limit=None):
+        """
+        Lease the next batch of users of a layer
+
+        Parameters:
+            layer   (int)               Layer to lease from
+            size    (int)       [50]    Max users in the batch
+            limit   (int/None)  [None]  Max users of the layer handed out
+                                        in total (userLimit)
+
+        Returns:
+            (list/None) Usernames, empty if the remaining users are leased
+                        by other processes, None once the layer is finished
+        """
+        now = time.time()
+        expires = now + self.leaseSeconds
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Users of an abandoned batch completed before the process died
+            # (checkpointed but not marked done) are not leased again
+            self.conn.execute(
+                """UPDATE leases SET done = 1
+                WHERE layer = ? AND done = 0 AND expires < ? AND EXISTS(
+                    SELECT 1 FROM completed c WHERE c.layer = leases.layer AND c.username = leases.username
+                )""",
+                (layer, now),
+            )
+            # Batches abandoned by another process come first
+            expired = [
+                i[0]
+                for i in self.conn.execute(
+                    "SELECT username FROM leases WHERE layer = ? AND done = 0 AND expires < ? LIMIT ?",
+                    (layer, now, size),
+                )
+            ]
+            if expired:
+                self.conn.executemany(
+                    "UPDATE leases SET worker = ?, expires = ? WHERE layer = ? AND username = ?",
+                    ((self.worker, expires, layer, i) for i in expired),
+                )
+                self.conn.execute("COMMIT")
+                return expired
+
+            row = self.conn.execute(
+                "SELECT refs, rowid_, taken FROM lease_cursors WHERE layer = ?", (layer,)
+            ).fetchone()
+            refs, rowid, taken = row if row is not None else (None, 0, 0)
+
+            batch = []
+            while not batch:
+                remaining = size if limit is None else min(size, limit - taken)
+                if remaining <= 0:
+                    break
+                rows = self.__next_rows(layer, (refs, rowid), remaining)
+                if not rows:
+                    break
+                rowid, refs = rows[-1][0], rows[-1][1]
+                taken += len(rows)
+                # Users completed before a restart are not leased again
+                batch = [username for _, _, username, done in rows if not done]
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO lease_cursors (layer, refs, rowid_, taken) VALUES (?, ?, ?, ?)",
+                (layer, refs, rowid, taken),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO leases (layer, username, worker, expires, done) VALUES (?, ?, ?, ?, 0)",
+                ((layer, i, self.worker, expires) for i in batch),
+            )
+
+            if not batch:
+                (active,) = self.conn.execute(
+                    "SELECT COUNT(*) FROM leases WHERE layer = ? AND done = 0", (layer,)
+                ).fetchone()
+                self.conn.execute("COMMIT")
+                return [] if active else None
+            self.conn.execute("COMMIT")
+            return batch
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, layer, usernames):
+        """Extend this process' lease on users it is still working on"""
+        self.conn.executemany(
+            "UPDATE leases SET expires = ? WHERE layer = ? AND username = ? AND worker = ? AND done = 0",
+            ((time.time() + self.leaseSeconds, layer, i, self.worker) for i in usernames),
+        )
+
+    def complete(self, layer, usernames):
+        self.conn.executemany(
+            "UPDATE leases SET done = 1 WHERE layer = ? AND username = ?",
+            ((layer, i) for i in usernames),
+        )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,132 @@
+import re
+import zlib
+from array import array
+from collections import OrderedDict
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def lsh_bands(numPerm, threshold):
+    """
+    Split a signature into (bands, rows) so that texts with a Jaccard
+    similarity around `threshold` start sharing a band, (1/b)^(1/r)
+    """
+    return min(
+        (
+            (bands, numPerm // bands)
+            for bands in range(1, numPerm + 1)
+            if numPerm % bands == 0
+        ),
+        key=lambda i: abs((1 / i[0]) ** (1 / i[1]) - threshold),
+    )
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detection with MinHash signatures and an LSH
+    index. Signatures use one permutation hashing (every shingle is hashed
+    once and binned), so the cost is linear in the length of the text.
+
+    A shared band only makes a text a candidate: every band key keeps a
+    compact copy of its text's signature (16 bits per slot), and a text is
+    only a duplicate if its estimated similarity to a candidate reaches
+    `threshold`.
+
+    The index is a sliding window over the last `capacity` comments (about
+    1 KiB each, so 100 MiB by default); the least recently matched band keys
+    are forgotten first (copypasta keeps being seen, so it stays).
+    """
+
+    def __init__(
+        self, threshold=0.8, numPerm=64, shingle=5, minLength=30, capacity=100000
+    ):
+        self.threshold = threshold
+        self.numPerm = numPerm
+        self.shingle = shingle
+        self.minLength = minLength
+        self.capacity = capacity
+        self.bands, self.rows = lsh_bands(numPerm, threshold)
+        self.store = OrderedDict()  # Band key -> sketch
+
+        self.seen = 0
+        self.dropped = 0
+
+    def signature(self, text):
+        data = WHITESPACE.sub(" ", text.lower()).strip().encode("utf-8")
+        size, shingle, crc32 = self.numPerm, self.shingle, zlib.crc32
+        empty = 1 << 32
+        signature = [empty] * size
+        shingles = {
+            crc32(data[i : i + shingle]) for i in range(max(len(data) - shingle + 1, 1))
+        }
+        for h in shingles:
+            slot, value = h % size, h // size
+            if value < signature[slot]:
+                signature[slot] = value
+
+        # Densify: empty bins borrow from the next filled bin
+        if empty in signature:
+            filled = [i for i in range(size) if signature[i] != empty]
+            if not filled:
+                return signature
+            for i in range(size):
+                if signature[i] == empty:
+                    j = next((k for k in filled if k > i), filled[0])
+                    signature[i] = signature[j] + (j - i) % size
+        return signature
+
+    def similarity(self, sketch, other):
+        """Estimated Jaccard similarity of two sketches"""
+        a, b = memoryview(sketch).cast("H"), memoryview(other).cast("H")
+        return sum(i == j for i, j in zip(a, b)) / self.numPerm
+
+    def __keys(self, signature):
+        rows = self.rows
+        return [
+            hash((band, *signature[band * rows : (band + 1) * rows]))
+            for band in range(self.bands)
+        ]
+
+    def is_duplicate(self, text):
+        """
+        Check a text against everything seen so far, then remember it
+
+        Returns:
+            (bool)
+        """
+        self.seen += 1
+        if len(text) < self.minLength:
+            return False
+
+        signature = self.signature(text)
+        sketch = array("H", (i & 0xFFFF for i in signature)).tobytes()
+        duplicate = False
+        store = self.store
+        for key in self.__keys(signature):
+            other = store.get(key)
+            if other is None:
+                store[key] = sketch
+                continue
+            # Move to the back so frequently repeated texts are kept
+            store.move_to_end(key)
+            if not duplicate and self.similarity(sketch, other) >= self.threshold:
+                duplicate = True
+        while len(store) > self.capacity * self.bands:
+            store.popitem(last=False)
+
+        if duplicate:
+            self.dropped += 1
+        return duplicate
+
+    def filter(self, comments):
+        """
+        Parameters:
+            comments    (iterable)  [{"comment": comment (str), ...}, ...]
+
+        Returns:
+            (list) The comments that are not near-duplicates
+        """
+        return [i for i in comments if not self.is_duplicate(i["comment"])]
+
+    def reset_stats(self):
+        self.seen, self.dropped = 0, 0
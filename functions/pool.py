@@ -0,0 +1,124 @@
+import itertools
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Chunk produced for an item that failed in a way worth retrying later
+# (network errors, server errors), before its usual None
+FAILED = "failed"
+
+
+def stream_bounded(func, items, workers=1, buffered=2):
+    """
+    Run a generator function over items on a pool of worker threads,
+    keeping at most `workers` items in flight. Every chunk is handed to
+    the calling thread as soon as it is produced (so the caller can act
+    as the single writer), followed by a None once that item is finished.
+    At most `buffered` chunks per worker wait to be consumed.
+
+    `items` can also be a callable returning the next item, or None when
+    there is nothing to do right now. It is asked again after every chunk
+    (the caller may have queued more work while handling it), and the
+    stream ends once it returns None with nothing left in flight.
+
+    Parameters:
+        func        (callable)          Called as func(index, item),
+                                        returns an iterable of chunks
+        items       (iterable/callable) Items to process
+        workers     (int)       [1]     Maximum concurrent items
+        buffered    (int)       [2]     Chunks buffered per worker
+
+    Returns:
+        (generator)
+        (
+            (item, chunk / None),
+            ...
+        )
+    """
+    workers = max(1, workers)
+    take = items if callable(items) else iter(items).__next__
+    counter = itertools.count()
+    chunks = queue.Queue(maxsize=workers * buffered)
+    closed = threading.Event()
+
+    def put(value):
+        # Gives up once the consumer has stopped reading
+        while not closed.is_set():
+            try:
+                chunks.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(i, item):
+        try:
+            for chunk in func(i, item):
+                if closed.is_set():
+                    return
+                put((i, item, chunk))
+        finally:
+            put((i, item, None))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit():
+            try:
+                item = take()
+            except StopIteration:
+                return False
+            if item is None:
+                return False
+            i = next(counter)
+            pending[i] = executor.submit(run, i, item)
+            return True
+
+        try:
+            while len(pending) < workers and submit():
+                pass
+
+            while pending:
+                i, item, chunk = chunks.get()
+                if chunk is None:
+                    # Raises the worker's exception, if any
+                    pending.pop(i).result()
+                yield item, chunk
+                while len(pending) < workers and submit():
+                    pass
+        finally:
+            closed.set()
+
+
+def prefetch_batches(items, prefetch, size=100):
+    """
+    Source for stream_bounded which takes items `size` at a time and calls
+    prefetch on each batch before handing its items out one by one, so
+    lookups needed for every item can be made in bulk
+
+    Parameters:
+        items       (iterable/callable) Items, as for stream_bounded
+        prefetch    (callable)          Called as prefetch(batch)
+        size        (int)       [100]   Max items per batch
+
+    Returns:
+        (callable)  Next item, None when there is nothing to do right now
+    """
+    take = items if callable(items) else iter(items).__next__
+    ready = deque()
+
+    def next_item():
+        if not ready:
+            while len(ready) < size:
+                try:
+                    item = take()
+                except StopIteration:
+                    break
+                if item is None:
+                    break
+                ready.append(item)
+            if ready:
+                prefetch(list(ready))
+        return ready.popleft() if ready else None
+
+    return next_item
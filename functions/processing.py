@@ -1,25 +1,131 @@
 import praw
+import prawcore
 import dotenv
 import os
 import itertools
+from itertools import islice
+from collections import deque
 from colorama import Fore, Style
 import traceback
 
-from functions.general import progress_bar, normalize_range
+from functions.general import progress_bar, normalize_range, get_credentials
+from functions.pool import stream_bounded, prefetch_batches, FAILED
+from functions.cache import CachedSubmission
+from functions.ratelimit import LimiterPool
+from functions.transport import (
+    Archive,
+    LimitedRequestor,
+    PooledSession,
+    RecordingRequestor,
+    ReplayRequestor,
+    TIMEOUT,
+)
 
 dotenv.load_dotenv()
 
-id = os.getenv("client_id")
-secret = os.getenv("client_secret")
+# Every OAuth app configured gets its own client and quota
+credentials = get_credentials()
+id, secret = credentials[0] if credentials else (None, None)
 ua = os.getenv("user_agent")
 
 from_iterable = itertools.chain.from_iterable
 
-r = praw.Reddit(client_id=id, client_secret=secret, user_agent=ua)
-r.config.log_requests = 0
+# Users these are raised for (deleted, suspended, private) will never be
+# fetched, anything else is worth retrying later
+PERMANENT_ERRORS = (
+    prawcore.exceptions.NotFound,
+    prawcore.exceptions.Forbidden,
+    prawcore.exceptions.Redirect,
+    prawcore.exceptions.UnavailableForLegalReasons,
+    AttributeError,  # Suspended accounts have no profile attributes
+)
+
+limiter = LimiterPool(len(credentials))
+session = PooledSession()
+archive = None
+clients = []
+
+
+def setup_reddit(record=None, replay=None):
+    """
+    (Re)create the reddit clients, one per configured app
+
+    Parameters:
+        record  (str/None)  [None]  Store every HTTP exchange in this file
+        replay  (str/None)  [None]  Answer every request from this file
+                                    instead of the network
+    """
+    global r
+    global archive
+    global clients
+
+    requestorClass = LimitedRequestor
+    requestorKwargs = {"session": session, "timeout": TIMEOUT}
+    apps = [
+        {"client_id": i, "client_secret": j, "user_agent": ua} for i, j in credentials
+    ]
+    if record:
+        # Recordings are replayed through one client, so only the first
+        # app is used
+        archive = Archive(record)
+        requestorClass = RecordingRequestor
+        requestorKwargs["archive"] = archive
+        apps = [{"client_id": id, "client_secret": secret, "user_agent": ua}]
+    elif replay:
+        archive = Archive(replay)
+        requestorClass = ReplayRequestor
+        # Nothing reaches reddit, so neither the limiter nor real credentials
+        # are needed
+        requestorKwargs = {"archive": archive}
+        apps = [
+            {
+                "client_id": id or "replay",
+                "client_secret": secret or "replay",
+                "user_agent": ua or "kularity:replay",
+            }
+        ]
+
+    clients = []
+    for i, app in enumerate(apps):
+        client = praw.Reddit(
+            **app,
+            requestor_class=requestorClass,
+            requestor_kwargs={
+                "limiter": None if replay else limiter[i],
+                **requestorKwargs,
+            },
+        )
+        client.config.log_requests = 0
+        clients.append(client)
+    r = clients[0]
+
+
+def set_pool_size(workers):
+    # Every worker gets its own kept-alive connection
+    limiter.set_max_concurrency(workers)
+    session.resize(workers)
+
+
+def connection_stats():
+    return session.connection_stats()
+
+
+def reset_connection_stats():
+    session.reset_stats()
+
+
+r = None
+if credentials:
+    setup_reddit()
+
 skw = Fore.CYAN
 ekw = Style.RESET_ALL
 
+INFO_BATCH = 100  # Max fullnames per /api/info request
+PAGE_SIZE = 100  # Items per listing request
+submissionCache = None
+subredditCache = None
+
 
 def clean_users(userList):
     return [i for i in userList if i not in blockedUsers]
@@ -32,6 +138,16 @@ def set_lp_logger(_logger, _verbose):
     verbose = _verbose
 
 
+def set_submission_cache(cache):
+    global submissionCache
+    submissionCache = cache
+
+
+def set_subreddit_cache(cache):
+    global subredditCache
+    subredditCache = cache
+
+
 def set_blocked(
     users,
     nsfw,
@@ -64,7 +180,7 @@ def set_blocked(
 
     restrictedSubs = {
         "active": True if len(restrictSubs) > 0 else False,
-        "subs": [r.subreddit(i) for i in restrictSubs],
+        "subs": {i.lower() for i in restrictSubs},
     }
     if len(restrictedSubs) > 0:
         logger.info(f"Restricting to {len(restrictSubs)} subreddits")
@@ -79,29 +195,137 @@ def checkSubreddit(name):
         return False
 
 
+def prefetch_subreddits(subreddits):
+    """
+    Load metadata for many subreddits into the subreddit cache,
+    100 per info request
+
+    Parameters:
+        subreddits  (list)                  Subreddits or their names
+    """
+    if subredditCache is None:
+        return
+    names = list(dict.fromkeys(str(i).lower() for i in subreddits))
+    names = [i for i in names if i not in subredditCache.get_many(names)]
+    if names:
+        subredditCache.put_many(
+            (i.display_name, i.over18, i.subscribers)
+            for i in r.info(subreddits=names)
+        )
+        if verbose:
+            logger.debug(f"Prefetched {skw}{len(names)}{ekw} subreddits")
+
+
+def prefetch_profiles(users):
+    """
+    Load the profile subreddits (u_<name>) of many redditors into the
+    subreddit cache, so their NSFW checks need no request of their own
+
+    Parameters:
+        users       (list)                  Redditors or their names
+    """
+    try:
+        prefetch_subreddits([f"u_{i}" for i in users if i is not None])
+    except Exception:
+        # Each profile is then fetched when it is checked
+        logger.warning(f"Failed to prefetch profiles: {traceback.format_exc()}")
+
+
+def subreddit_over18(subj):
+    """
+    Whether a subreddit (or a redditor's profile) is NSFW, using the
+    subreddit cache before fetching it
+    """
+    if isinstance(subj, praw.models.Subreddit):
+        name = subj.display_name
+    else:
+        name = f"u_{subj.name}"
+
+    if subredditCache is not None:
+        cached = subredditCache.get(name.lower())
+        if cached is not None:
+            return bool(cached[0])
+
+    if isinstance(subj, praw.models.Subreddit):
+        row = (name, subj.over18, subj.subscribers)
+    else:
+        row = (name, subj.subreddit["over_18"], subj.subreddit["subscribers"])
+    if subredditCache is not None:
+        subredditCache.put_many([row])
+    return bool(row[1])
+
+
 def checkSafe(subj):
     """
     False: NSFW
     True: Safe
     """
-    try:
-        if blockNSFW and subj.subreddit["over_18"]:
-            logger.warning(f"Blocked nsfw {subj.name}")
-            return False
-    except Exception:
-        if blockNSFW and subj.over18:
+    if blockNSFW and subreddit_over18(subj):
+        if isinstance(subj, praw.models.Subreddit):
             logger.warning(f"Blocked subreddit {subj.display_name_prefixed}")
-            return False
+        else:
+            logger.warning(f"Blocked nsfw {subj.name}")
+        return False
     return True
 
 
 def checkSub(subj):
     if restrictedSubs["active"]:
-        if subj not in restrictedSubs["subs"]:
+        if str(subj).lower() not in restrictedSubs["subs"]:
             return False
     return True
 
 
+def resolve_submissions(comments, resolved=(), reddit=None):
+    """
+    Fetch the submissions of the next batch of comments in a single
+    info request rather than one request per comment
+
+    Parameters:
+        comments    (list)                  Comments in listing order
+        resolved    (dict/set)  [()]        Fullnames to skip
+        reddit      (Reddit)    [r]         Client to fetch with
+
+    Returns:
+        (dict)
+        {
+            fullname (str): submission (Submission/None),
+            ...
+        }
+    """
+    reddit = reddit or r
+    fullnames = list(
+        dict.fromkeys(i.link_id for i in comments if i.link_id not in resolved)
+    )[:INFO_BATCH]
+    # Missing submissions stay None so they are never requested twice
+    submissions = dict.fromkeys(fullnames)
+
+    if submissionCache is not None:
+        cached = submissionCache.get_many(fullnames)
+        for fullname, (author, subreddit) in cached.items():
+            submissions[fullname] = CachedSubmission(
+                reddit.redditor(author) if author is not None else None,
+                reddit.subreddit(subreddit),
+            )
+        fullnames = [i for i in fullnames if i not in cached]
+
+    if fullnames:
+        fetched = list(reddit.info(fullnames=fullnames))
+        submissions.update((i.fullname, i) for i in fetched)
+        if submissionCache is not None:
+            submissionCache.put_many(
+                (
+                    i.fullname,
+                    i.author.name if i.author is not None else None,
+                    i.subreddit.display_name,
+                )
+                for i in fetched
+            )
+    if verbose:
+        logger.debug(f"Resolved {skw}{len(fullnames)}{ekw} submissions")
+    return submissions
+
+
 def users_from_posts(subreddit, sorting="hot", limit=100):
     """
     Collects submission IDs with author names from a subreddit
@@ -145,7 +369,7 @@ def users_from_posts(subreddit, sorting="hot", limit=100):
     return [i[0] for i in values], [i[1] for i in values]
 
 
-def get_post_comments(submission, limit=5000):
+def get_post_comments(submission, limit=5000, requestBudget=32):
     """
     Get comment authors from submission
 
@@ -153,6 +377,8 @@ def get_post_comments(submission, limit=5000):
         submission  (Submission)            Submission to use
                     (list/tuple)
         limit       (int)           [5000]  Max commments to get
+        requestBudget (int)         [32]    Max "load more" requests
+                                            per submission
 
     Returns:
         (list)
@@ -174,35 +400,54 @@ def get_post_comments(submission, limit=5000):
 
         if not checkSafe(submission.subreddit):
             logger.warning(f"Skipping {skw}{submission.id}{ekw} (NSFW)")
-            return ()
-        # submission.comments.replace_more(limit=None)
-        queue = submission.comments[:]
+            return (), []
+
+        # Breadth-first, expanding "load more" stubs while the budget lasts
+        queue = deque(submission.comments[:])
+        budget = requestBudget
 
         data, comments = [], []
         while queue and limit > len(data):
+            comment = queue.popleft()
+            if isinstance(comment, praw.models.MoreComments):
+                if budget > 0:
+                    budget -= 1
+                    queue.extend(comment.comments())
+                continue
             try:
-                comment = queue.pop(0)
-            except IndexError:
-                break
-            try:
-                if comment.author not in blockedUsers and checkSafe(comment.author):
+                # NSFW profiles are filtered below, once for all authors
+                if comment.author not in blockedUsers:
                     data.append(comment.author)
                 if limit > len(data):
                     queue.extend(comment.replies)
                     comments.append(
                         {
+                            "id": int(comment.id, 36),
                             "comment": comment.body,
                             "score": comment.score,
                         }
                     )
             except Exception:
-                break
+                if verbose:
+                    logger.debug(f"Skipping comment {skw}{comment.id}{ekw}")
+
+        data = list(dict.fromkeys(data))
+        if blockNSFW:
+            prefetch_profiles(data)
+            data = [i for i in data if safe_author(i)]
 
         if verbose:
             logger.debug(
-                f"Got {skw}{len(data)}{ekw}/{skw}{limit}{ekw} comments from {skw}{submission.id}"
+                f"Got {skw}{len(data)}{ekw}/{skw}{limit}{ekw} comments from {skw}{submission.id}{ekw} ({requestBudget - budget} more requests)"
             )
-        return tuple(dict.fromkeys(data)), comments
+        return tuple(data), comments
+
+    def safe_author(author):
+        try:
+            return checkSafe(author)
+        except Exception:
+            # Deleted or suspended
+            return False
 
     def handleIteration(s, i, _max):
         data = getData(s)
@@ -210,6 +455,8 @@ def get_post_comments(submission, limit=5000):
         return data
 
     if isinstance(submission, (list, tuple)):
+        if blockNSFW:
+            prefetch_subreddits([i.subreddit for i in submission])
         _max = len(submission)
         rv = [handleIteration(s, i, _max) for i, s in enumerate(submission)]
         a, b = tuple(from_iterable([i[0] for i in rv])), tuple(
@@ -221,7 +468,7 @@ def get_post_comments(submission, limit=5000):
         return getData(submission)
 
 
-def get_user_comments(
+def iter_user_comments(
     user,
     normalize,
     sorting="new",
@@ -230,137 +477,253 @@ def get_user_comments(
     submissionLimit=10,
     userID=1,
     lenUsers=1,
+    reddit=None,
 ):
     """
-    Gets a maximum of 1000 comments from a users profile along
-    with their scores. The author of the submission of each
-    comment will also be supplied.
+    Streaming form of get_user_comments. Comments are read from the
+    listing one page at a time and yielded as soon as that page's
+    submission authors are resolved, so peak memory per user is one page.
 
     Parameters:
-        username    (Redditor)              Username to scrape from
+        username    (Redditor/str)          Username to scrape from
         normalized  (dict)                  Normalize argument
         sorting     (str)       ["new"]     Sorting to scrape with
         limit       (int/None)  [None]      Max comments to scrape
+        reddit      (Reddit)    [r]         Client to fetch with
 
     Returns:
-        (list)
-        [
+        (generator)
+        (
             (
-                submissionAuthor (Redditor),
-                ...
+                (submissionAuthor (Redditor), ...),
+                ({"id": id (int), "comment": comment (str), "score": score (int)}, ...)
             ),
-            (
-                {
-                    "comment": commentExample (str),
-                    "score": score (int)
-                },
-                ...
-            )
-        ]
+            ...
+        )
     """
+    reddit = reddit or r
     if isinstance(user, str):
         try:
-            user = r.redditor(user)
+            user = reddit.redditor(user)
         except Exception:
             logger.warning(f"u/{user} cannot be found")
-            return ((), ())
+            return
     if verbose:
         logger.info(
             f"Getting {skw}{limit}{ekw} comments from u/{skw}{user.name}{ekw} sorting by {skw}{sorting}{ekw} (limitUsers={skw}{limitUsers}{ekw}, submissionLimit={skw}{submissionLimit}{ekw})"
         )
 
-    def getData(user, baseCommentsSaved):
-        if verbose:
-            logger.debug(f"Getting {skw}{limit}{ekw} comments from {skw}{user.name}")
+    maxCommentsSaved = (lenUsers + 1) * limit  # Target comments (max)
+    baseCommentsSaved = userID * limit
+    commentCount, submissionCount = 0, 0
+    seen = set()
 
+    try:
         if not checkSafe(user):
-            return ((), ())
+            return
 
         method = getattr(user.comments, sorting)
         response = method(limit=limit)
-        lr = list(response)
-        if verbose:
-            logger.debug(f"Got response of {len(lr)} items")
-        commentData, submissionData = [], []
 
-        for j, i in enumerate(lr):
-            try:
-                if len(submissionData) < submissionLimit:
-                    if i.submission.author not in blockedUsers:
-                        if checkSub(i.submission.subreddit):
-                            submissionData.append(i.submission.author)
-                            if verbose:
-                                logger.debug(
-                                    f"Collected submission author u/{skw}{i.submission.author}"
-                                )
-                        else:
-                            logger.warning(f"Skipping beyond restriction")
-                    commentData.append(
-                        {
-                            "comment": i.body,
-                            "score": normalize_range(
-                                i.score,
-                                _max=normalize["max"],
-                                _min=normalize["min"],
+        # Comments are only kept while under submissionLimit, so the
+        # listing is not read any further than that
+        for page in iter(lambda: list(islice(response, PAGE_SIZE)), []):
+            if verbose:
+                logger.debug(f"Got page of {len(page)} items")
+            commentData, submissionData = [], []
+            submissions = {}
+
+            for j, i in enumerate(page):
+                if submissionCount >= submissionLimit:
+                    break
+                try:
+                    if submissionCount < submissionLimit:
+                        if i.link_id not in submissions:
+                            submissions.update(
+                                resolve_submissions(page[j:], submissions, reddit)
                             )
-                            if normalize["normalize"]
-                            else i.score,
-                        }
-                    )
+                        submission = submissions[i.link_id]
+                        if submission.author not in blockedUsers:
+                            if checkSub(submission.subreddit):
+                                submissionCount += 1
+                                if submission.author not in seen:
+                                    seen.add(submission.author)
+                                    submissionData.append(submission.author)
+                                if verbose:
+                                    logger.debug(
+                                        f"Collected submission author u/{skw}{submission.author}"
+                                    )
+                            else:
+                                logger.warning("Skipping beyond restriction")
+                        commentData.append(
+                            {
+                                "id": int(i.id, 36),
+                                "comment": i.body,
+                                "score": normalize_range(
+                                    i.score,
+                                    _max=normalize["max"],
+                                    _min=normalize["min"],
+                                )
+                                if normalize["normalize"]
+                                else i.score,
+                            }
+                        )
+
+                    if not verbose:
+                        progress_bar(
+                            baseCommentsSaved + commentCount + len(commentData),
+                            maxCommentsSaved,
+                            alwaysReturn=True,
+                            start=f"Getting u/{user.name} comments: ",
+                        )
+                except AttributeError:
+                    # NoneType (user is deleted or banned)
+                    logger.warning(f"{skw}{i}{ekw} is deleted/banned/otherwise")
+
+            commentCount += len(commentData)
+            yield tuple(submissionData), tuple(commentData)
+            if submissionCount >= submissionLimit:
+                break
+    except PERMANENT_ERRORS as e:
+        logger.warning(f"u/{user} is unavailable ({type(e).__name__})")
+        return
+    except Exception:
+        # Raised so the caller can retry the user instead of treating the
+        # user as finished
+        logger.error(traceback.format_exc())
+        raise
 
-                if not verbose:
-                    progress_bar(
-                        baseCommentsSaved[0] + len(commentData),
-                        maxCommentsSaved,
-                        alwaysReturn=True,
-                        start=f"Getting u/{user.name} comments: ",
-                    )
-            except AttributeError:
-                # NoneType (user is deleted or banned)
-                logger.warning(f"{skw}{i}{ekw} is deleted/banned/otherwise")
-                pass
+    if verbose:
+        logger.info(f"Received {skw}{commentCount}{ekw} comments for u/{skw}{user.name}")
+        logger.info(
+            f"Received {skw}{len(seen)}{ekw} submission authors for u/{skw}{user.name}"
+        )
 
-        if verbose:
-            logger.info(
-                f"Received {skw}{len(commentData)}{ekw} comments for u/{skw}{user.name}"
-            )
-            logger.info(
-                f"Received {skw}{len(submissionData)}{ekw} submission authors for u/{skw}{user.name}"
-            )
-        return tuple(dict.fromkeys(submissionData)), tuple(commentData)
 
+def get_user_comments(
+    user,
+    normalize,
+    sorting="new",
+    limit=None,
+    limitUsers=None,
+    submissionLimit=10,
+    userID=1,
+    lenUsers=1,
+):
+    """
+    Gets a maximum of 1000 comments from a users profile along
+    with their scores. The author of the submission of each
+    comment will also be supplied.
+
+    Parameters:
+        username    (Redditor)              Username to scrape from
+        normalized  (dict)                  Normalize argument
+        sorting     (str)       ["new"]     Sorting to scrape with
+        limit       (int/None)  [None]      Max comments to scrape
+
+    Returns:
+        (list)
+        [
+            (
+                submissionAuthor (Redditor),
+                ...
+            ),
+            (
+                {
+                    "id": commentID (int),
+                    "comment": commentExample (str),
+                    "score": score (int)
+                },
+                ...
+            )
+        ]
+    """
     if isinstance(user, (list, tuple)):
         if limitUsers is None:
             limitUsers = len(user)
-
-        commentData, submissionData = [], []
         listIter = user[:limitUsers]
-        maxCommentsSaved = len(listIter) * limit  # Target comments (max)
-        baseCommentsSaved = 0
-        progress_bar(
-            baseCommentsSaved, maxCommentsSaved, start="Getting user comments: "
-        )
+        users = enumerate(listIter)
+        lenUsers = len(listIter) - 1
+    else:
+        users = [(userID, user)]
 
-        for i, u in enumerate(listIter):
-            tmpSubmission, tmpComment = getData(u, baseCommentsSaved)
-            commentData.extend(tmpComment)
-            submissionData.extend(tmpSubmission)
-            baseCommentsSaved += limit
+    commentData, submissionData = [], []
+    for i, u in users:
+        try:
+            for tmpSubmission, tmpComment in iter_user_comments(
+                u,
+                normalize,
+                sorting=sorting,
+                limit=limit,
+                limitUsers=limitUsers,
+                submissionLimit=submissionLimit,
+                userID=i,
+                lenUsers=lenUsers,
+            ):
+                submissionData.extend(tmpSubmission)
+                commentData.extend(tmpComment)
+        except Exception:
+            # Already logged, keep what was received
+            pass
 
+    if isinstance(user, (list, tuple)):
         logger.info(
             f"Received {skw}{len(commentData)}{ekw} comments for {skw}{limitUsers}{ekw}/{skw}{len(user)}{ekw} users"
         )
         logger.info(
             f"Received {skw}{len(submissionData)}{ekw} submission authors for {skw}{limitUsers}{ekw}/{skw}{len(user)}{ekw} users"
         )
+    return tuple(submissionData), tuple(commentData)
 
-        return (tuple(submissionData), tuple(commentData))
-    else:
-        maxCommentsSaved = (lenUsers + 1) * limit  # Target comments (max)
-        baseCommentsSaved = userID * limit
+
+def map_user_comments(usernames, normalize, workers=1, **kwargs):
+    """
+    Stream iter_user_comments over many usernames on a pool of worker
+    threads. Each user is fetched with the client of the app with the
+    most quota to spare (see LimiterPool). Each user's pages are
+    followed by a None result once that user is finished, preceded by
+    FAILED if the user could not be fetched for now (and should not be
+    counted as finished).
+
+    Parameters:
+        usernames   (iterable/callable)     Usernames to scrape from (see
+                                            functions.pool.stream_bounded
+                                            for callables)
+        normalize   (dict)                  Normalize argument
+        workers     (int)       [1]         Users fetched concurrently
+        **kwargs                            Passed to iter_user_comments
+
+    Returns:
+        (generator)
+        (
+            (
+                username (str),
+                (submissionAuthors (tuple), comments (tuple)) / FAILED / None
+            ),
+            ...
+        )
+    """
+
+    def fetch(i, user):
+        if verbose:
+            logger.debug(f"Getting {user} comments..")
+        # With a callable source the total is unknown, so progress is
+        # shown per user
+        userID = 0 if callable(usernames) else i
+        app = limiter.bind() if len(clients) > 1 else 0
         try:
-            rval = getData(user, (baseCommentsSaved, maxCommentsSaved))
+            yield from iter_user_comments(
+                user, normalize, userID=userID, reddit=clients[app], **kwargs
+            )
         except Exception:
-            logger.error(traceback.format_exc())
-            rval = ((), ())
-        return rval
+            # Already logged by iter_user_comments
+            yield FAILED
+        finally:
+            if len(clients) > 1:
+                limiter.unbind(app)
+
+    source = usernames
+    if blockNSFW and subredditCache is not None:
+        # Profile NSFW checks of a whole batch of users in one request
+        source = prefetch_batches(usernames, prefetch_profiles, size=INFO_BATCH)
+    return stream_bounded(fetch, source, workers=workers)
@@ -0,0 +1,834 @@
+import asyncio
+import atexit
+import aiohttp
+import asyncpraw
+import asyncprawcore
+import time
+import dotenv
+import os
+import itertools
+from collections import deque
+from colorama import Fore, Style
+from multidict import CIMultiDict, CIMultiDictProxy
+import traceback
+
+from functions.general import progress_bar, normalize_range, get_credentials
+from functions.cache import CachedSubmission
+from functions.ratelimit import LimiterPool
+from functions.pool import prefetch_batches, FAILED
+from functions.transport import TIMEOUT, RATELIMIT_HEADERS
+
+KEEPALIVE = 60  # Seconds an idle connection is kept open
+
+# Users these are raised for (deleted, suspended, private) will never be
+# fetched, anything else is worth retrying later
+PERMANENT_ERRORS = (
+    asyncprawcore.exceptions.NotFound,
+    asyncprawcore.exceptions.Forbidden,
+    asyncprawcore.exceptions.Redirect,
+    asyncprawcore.exceptions.UnavailableForLegalReasons,
+    AttributeError,  # Suspended accounts have no profile attributes
+)
+
+
+class AsyncConnectionStats:
+    """
+    Counts requests and new connections made by an aiohttp session
+    (the async equivalent of PooledSession.connection_stats)
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_start.append(self.__on_request)
+        self.trace.on_connection_create_end.append(self.__on_connection)
+
+    async def __on_request(self, session, context, params):
+        self.requests += 1
+
+    async def __on_connection(self, session, context, params):
+        self.connections += 1
+
+    def session(self, poolSize=1):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=max(1, poolSize), keepalive_timeout=KEEPALIVE
+            ),
+            timeout=aiohttp.ClientTimeout(total=None),
+            trace_configs=[self.trace],
+        )
+
+    def connection_stats(self):
+        return self.requests, self.connections
+
+    def reset_stats(self):
+        self.requests, self.connections = 0, 0
+
+
+class LimitedResponse:
+    """
+    aiohttp response without the rate limit headers (aiohttp's headers are
+    immutable), anything else is read from the response itself
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.headers = CIMultiDictProxy(
+            CIMultiDict(
+                (k, v)
+                for k, v in response.headers.items()
+                if k.lower() not in RATELIMIT_HEADERS
+            )
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class AsyncLimitedRequestor(asyncprawcore.Requestor):
+    """
+    asyncprawcore equivalent of LimitedRequestor. The rate limit headers
+    are hidden from asyncprawcore so its own sleeping does not stack on top
+    of the shared limiter.
+    """
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    async def request(self, *args, **kwargs):
+        if self.limiter is None:
+            return await super().request(*args, **kwargs)
+
+        await self.limiter.acquire_async()
+        start = time.time()
+        response = None
+        try:
+            response = await super().request(*args, **kwargs)
+            return LimitedResponse(response)
+        finally:
+            self.limiter.release(
+                response.headers if response is not None else None,
+                time.time() - start,
+            )
+
+
+dotenv.load_dotenv()
+
+# Every OAuth app configured gets its own client and quota
+credentials = get_credentials()
+id, secret = credentials[0] if credentials else (None, None)
+ua = os.getenv("user_agent")
+
+from_iterable = itertools.chain.from_iterable
+
+loop = asyncio.new_event_loop()
+limiter = LimiterPool(len(credentials))
+connections = AsyncConnectionStats()
+poolSize = 1
+clients = {}
+skw = Fore.CYAN
+ekw = Style.RESET_ALL
+
+INFO_BATCH = 100  # Max fullnames per /api/info request
+PAGE_SIZE = 100  # Items per listing request
+submissionCache = None
+subredditCache = None
+
+
+async def get_reddit(app=0):
+    """
+    Client of one of the configured apps (the first by default)
+    """
+    # asyncpraw binds its HTTP session to the running loop, so the client
+    # is created lazily from inside it
+    if app not in clients:
+        clientID, clientSecret = credentials[app] if credentials else (id, secret)
+        clients[app] = asyncpraw.Reddit(
+            client_id=clientID,
+            client_secret=clientSecret,
+            user_agent=ua,
+            requestor_class=AsyncLimitedRequestor,
+            requestor_kwargs={
+                "limiter": limiter[app],
+                "session": connections.session(poolSize),
+                "timeout": aiohttp.ClientTimeout(
+                    sock_connect=TIMEOUT[0], sock_read=TIMEOUT[1]
+                ),
+            },
+        )
+        clients[app].config.log_requests = 0
+    return clients[app]
+
+
+def set_pool_size(workers):
+    # Every worker gets its own kept-alive connection
+    global poolSize
+    limiter.set_max_concurrency(workers)
+    poolSize = workers
+
+
+def connection_stats():
+    return connections.connection_stats()
+
+
+def reset_connection_stats():
+    connections.reset_stats()
+
+
+def run(coro):
+    return loop.run_until_complete(coro)
+
+
+async def new_queue(maxsize=0):
+    # Before Python 3.10 a queue binds to the loop current at creation,
+    # so it has to be created from inside this module's loop
+    return asyncio.Queue(maxsize=maxsize)
+
+
+@atexit.register
+def close():
+    for client in clients.values():
+        run(client.close())
+    loop.close()
+
+
+def clean_users(userList):
+    return [i for i in userList if i not in blockedUsers]
+
+
+def set_lp_logger(_logger, _verbose):
+    global logger
+    global verbose
+    logger = _logger
+    verbose = _verbose
+
+
+def set_submission_cache(cache):
+    global submissionCache
+    submissionCache = cache
+
+
+def set_subreddit_cache(cache):
+    global subredditCache
+    subredditCache = cache
+
+
+def set_blocked(
+    users,
+    nsfw,
+    subreddits,
+    minScore,
+    maxScore,
+    restrictSubs,
+):
+    global blockedUsers
+    global blockedSubreddits
+    global blockNSFW
+    global scoreRange
+    global restrictedSubs
+
+    blockedUsers = users["content"]
+    logger.info(f"Loaded {Fore.CYAN}{len(blockedUsers)}{Style.RESET_ALL} blocked users")
+
+    blockedSubreddits = subreddits["content"]
+    logger.info(
+        f"Loaded {Fore.CYAN}{len(blockedSubreddits)}{Style.RESET_ALL} blocked subreddits"
+    )
+
+    blockNSFW = nsfw
+    logger.info("Blocking nsfw" if blockNSFW else "Not blocking nsfw")
+    if blockNSFW:
+        logger.warning("Blocking nsfw may skip many users")
+
+    scoreRange = (minScore, maxScore)
+    logger.info(f"Set score range {scoreRange[0]} to {scoreRange[1]}")
+
+    restrictedSubs = {
+        "active": True if len(restrictSubs) > 0 else False,
+        "subs": {i.lower() for i in restrictSubs},
+    }
+    if len(restrictedSubs) > 0:
+        logger.info(f"Restricting to {len(restrictSubs)} subreddits")
+
+
+async def prefetch_subreddits(subreddits):
+    """
+    Load metadata for many subreddits into the subreddit cache,
+    100 per info request
+
+    Parameters:
+        subreddits  (list)                  Subreddits or their names
+    """
+    if subredditCache is None:
+        return
+    reddit = await get_reddit()
+    names = list(dict.fromkeys(str(i).lower() for i in subreddits))
+    names = [i for i in names if i not in subredditCache.get_many(names)]
+    if names:
+        subredditCache.put_many(
+            [
+                (i.display_name, i.over18, i.subscribers)
+                async for i in reddit.info(subreddits=names)
+            ]
+        )
+        if verbose:
+            logger.debug(f"Prefetched {skw}{len(names)}{ekw} subreddits")
+
+
+async def prefetch_profiles(users):
+    """
+    Load the profile subreddits (u_<name>) of many redditors into the
+    subreddit cache, so their NSFW checks need no request of their own
+
+    Parameters:
+        users       (list)                  Redditors or their names
+    """
+    try:
+        await prefetch_subreddits([f"u_{i}" for i in users if i is not None])
+    except Exception:
+        # Each profile is then fetched when it is checked
+        logger.warning(f"Failed to prefetch profiles: {traceback.format_exc()}")
+
+
+def cached_over18(name):
+    if subredditCache is not None:
+        cached = subredditCache.get(name.lower())
+        if cached is not None:
+            return bool(cached[0])
+    return None
+
+
+async def checkSafeRedditor(subj):
+    """
+    False: NSFW
+    True: Safe
+    """
+    if blockNSFW:
+        over18 = cached_over18(f"u_{subj.name}")
+        if over18 is None:
+            await subj.load()
+            over18 = subj.subreddit["over_18"]
+            if subredditCache is not None:
+                subredditCache.put_many(
+                    [(f"u_{subj.name}", over18, subj.subreddit["subscribers"])]
+                )
+        if over18:
+            logger.warning(f"Blocked nsfw {subj.name}")
+            return False
+    return True
+
+
+async def checkSafeSubreddit(subj):
+    """
+    False: NSFW
+    True: Safe
+    """
+    if blockNSFW:
+        over18 = cached_over18(subj.display_name)
+        if over18 is None:
+            await subj.load()
+            over18 = subj.over18
+            if subredditCache is not None:
+                subredditCache.put_many(
+                    [(subj.display_name, over18, subj.subscribers)]
+                )
+        if over18:
+            logger.warning(f"Blocked subreddit {subj.display_name_prefixed}")
+            return False
+    return True
+
+
+def checkSub(subj):
+    if restrictedSubs["active"]:
+        if str(subj).lower() not in restrictedSubs["subs"]:
+            return False
+    return True
+
+
+async def resolve_submissions(comments, resolved=(), reddit=None):
+    """
+    Fetch the submissions of the next batch of comments in a single
+    info request rather than one request per comment
+
+    Parameters:
+        comments    (list)                  Comments in listing order
+        resolved    (dict/set)  [()]        Fullnames to skip
+        reddit      (Reddit)    [None]      Client to fetch with (first app if None)
+
+    Returns:
+        (dict)
+        {
+            fullname (str): submission (Submission/None),
+            ...
+        }
+    """
+    reddit = reddit or await get_reddit()
+    fullnames = list(
+        dict.fromkeys(i.link_id for i in comments if i.link_id not in resolved)
+    )[:INFO_BATCH]
+    # Missing submissions stay None so they are never requested twice
+    submissions = dict.fromkeys(fullnames)
+
+    if submissionCache is not None:
+        cached = submissionCache.get_many(fullnames)
+        for fullname, (author, subreddit) in cached.items():
+            submissions[fullname] = CachedSubmission(
+                await reddit.redditor(author) if author is not None else None,
+                subreddit,
+            )
+        fullnames = [i for i in fullnames if i not in cached]
+
+    if fullnames:
+        fetched = [i async for i in reddit.info(fullnames=fullnames)]
+        submissions.update((i.fullname, i) for i in fetched)
+        if submissionCache is not None:
+            submissionCache.put_many(
+                (
+                    i.fullname,
+                    i.author.name if i.author is not None else None,
+                    i.subreddit.display_name,
+                )
+                for i in fetched
+            )
+    if verbose:
+        logger.debug(f"Resolved {skw}{len(fullnames)}{ekw} submissions")
+    return submissions
+
+
+async def _users_from_posts(subreddit, sorting="hot", limit=100):
+    reddit = await get_reddit()
+
+    async def check(i):
+        if i.author is None:
+            return False
+        return i.author.name not in blockedUsers and await checkSafeRedditor(
+            i.author
+        )
+
+    if limit is None:
+        limit = 100
+
+    logger.debug(
+        f"Getting {skw}{limit}{ekw} posts from r/{skw}{subreddit}{ekw} sorting by {skw}{sorting}{ekw}"
+    )
+    method = getattr(await reddit.subreddit(subreddit), sorting)
+    lp = [i async for i in method(limit=limit)]
+    logger.debug(f"Got {skw}{len(lp)}/{limit}{ekw} posts")
+    values = [(i, i.author) for i in lp if await check(i)]
+    return [i[0] for i in values], [i[1] for i in values]
+
+
+def users_from_posts(subreddit, sorting="hot", limit=100):
+    """
+    Collects submission IDs with author names from a subreddit
+    from a starting point
+
+    Parameters:
+        subreddit   (str)               Subreddit to scrape
+        sorting     (str)   ["top"]     Sorting to scrape with
+        limit       (int)   [100]       Max submissions
+
+    Returns:
+        (list)
+        [
+            (
+                submission (Submission),
+                ...
+            ),
+            (
+                author (Redditor),
+                ...
+            )
+        ]
+    """
+    return run(_users_from_posts(subreddit, sorting=sorting, limit=limit))
+
+
+async def _get_post_comments(submission, limit=5000, requestBudget=32):
+    async def getData(submission):
+        if verbose:
+            logger.debug(
+                f"Getting {skw}{limit}{ekw} comments from submission {skw}{submission.id}{ekw}"
+            )
+
+        if not await checkSafeSubreddit(submission.subreddit):
+            logger.warning(f"Skipping {skw}{submission.id}{ekw} (NSFW)")
+            return (), []
+
+        # Breadth-first, expanding "load more" stubs while the budget lasts
+        forest = await submission.comments()
+        queue = deque(forest[:])
+        budget = requestBudget
+
+        data, comments = [], []
+        while queue and limit > len(data):
+            comment = queue.popleft()
+            if isinstance(comment, asyncpraw.models.MoreComments):
+                if budget > 0:
+                    budget -= 1
+                    queue.extend(await comment.comments())
+                continue
+            try:
+                # NSFW profiles are filtered below, once for all authors
+                if comment.author not in blockedUsers:
+                    data.append(comment.author)
+                if limit > len(data):
+                    queue.extend(comment.replies[:])
+                    comments.append(
+                        {
+                            "id": int(comment.id, 36),
+                            "comment": comment.body,
+                            "score": comment.score,
+                        }
+                    )
+            except Exception:
+                if verbose:
+                    logger.debug(f"Skipping comment {skw}{comment.id}{ekw}")
+
+        data = list(dict.fromkeys(data))
+        if blockNSFW:
+            await prefetch_profiles(data)
+            data = [i for i in data if await safe_author(i)]
+
+        if verbose:
+            logger.debug(
+                f"Got {skw}{len(data)}{ekw}/{skw}{limit}{ekw} comments from {skw}{submission.id}{ekw} ({requestBudget - budget} more requests)"
+            )
+        return tuple(data), comments
+
+    async def safe_author(author):
+        try:
+            return await checkSafeRedditor(author)
+        except Exception:
+            # Deleted or suspended
+            return False
+
+    if isinstance(submission, (list, tuple)):
+        if blockNSFW:
+            await prefetch_subreddits([i.subreddit for i in submission])
+        _max = len(submission)
+        rv = []
+        for i, s in enumerate(submission):
+            rv.append(await getData(s))
+            progress_bar(i + 1, _max, start="Getting comments: ")
+        a, b = tuple(from_iterable([i[0] for i in rv])), tuple(
+            from_iterable([i[1] for i in rv])
+        )
+        return a, b
+    else:
+        return await getData(submission)
+
+
+def get_post_comments(submission, limit=5000, requestBudget=32):
+    """
+    Get comment authors from submission
+
+    Parameters:
+        submission  (Submission)            Submission to use
+                    (list/tuple)
+        limit       (int)           [5000]  Max commments to get
+        requestBudget (int)         [32]    Max "load more" requests
+                                            per submission
+
+    Returns:
+        (list)
+        [
+            author (Redditor),
+            ...
+        ]
+    """
+    if verbose:
+        logger.info(
+            f"Getting {skw}{limit}{ekw} comments from {skw}{len(submission)}{ekw} submissions"
+        )
+    return run(
+        _get_post_comments(submission, limit=limit, requestBudget=requestBudget)
+    )
+
+
+async def iter_user_comments(
+    user,
+    normalize,
+    sorting="new",
+    limit=None,
+    limitUsers=None,
+    submissionLimit=10,
+    reddit=None,
+):
+    """
+    Streaming form of get_user_comments. Comments are read from the
+    listing one page at a time and yielded as soon as that page's
+    submission authors are resolved, so peak memory per user is one page.
+
+    Parameters:
+        username    (Redditor/str)          Username to scrape from
+        normalized  (dict)                  Normalize argument
+        sorting     (str)       ["new"]     Sorting to scrape with
+        limit       (int/None)  [None]      Max comments to scrape
+        reddit      (Reddit)    [None]      Client to fetch with (first app if None)
+
+    Returns:
+        (async generator)
+        (
+            (
+                (submissionAuthor (Redditor), ...),
+                ({"id": id (int), "comment": comment (str), "score": score (int)}, ...)
+            ),
+            ...
+        )
+    """
+    commentCount, submissionCount = 0, 0
+    seen = set()
+
+    async def getPage(page):
+        nonlocal submissionCount
+        commentData, submissionData = [], []
+        submissions = {}
+
+        for j, i in enumerate(page):
+            if submissionCount >= submissionLimit:
+                break
+            try:
+                if i.link_id not in submissions:
+                    submissions.update(
+                        await resolve_submissions(page[j:], submissions, reddit)
+                    )
+                submission = submissions[i.link_id]
+                if submission.author not in blockedUsers:
+                    if checkSub(submission.subreddit):
+                        submissionCount += 1
+                        if submission.author not in seen:
+                            seen.add(submission.author)
+                            submissionData.append(submission.author)
+                        if verbose:
+                            logger.debug(
+                                f"Collected submission author u/{skw}{submission.author}"
+                            )
+                    else:
+                        logger.warning("Skipping beyond restriction")
+                commentData.append(
+                    {
+                        "id": int(i.id, 36),
+                        "comment": i.body,
+                        "score": normalize_range(
+                            i.score,
+                            _max=normalize["max"],
+                            _min=normalize["min"],
+                        )
+                        if normalize["normalize"]
+                        else i.score,
+                    }
+                )
+            except AttributeError:
+                # NoneType (user is deleted or banned)
+                logger.warning(f"{skw}{i}{ekw} is deleted/banned/otherwise")
+        return tuple(submissionData), tuple(commentData)
+
+    try:
+        reddit = reddit or await get_reddit()
+        if isinstance(user, str):
+            user = await reddit.redditor(user)
+        if verbose:
+            logger.info(
+                f"Getting {skw}{limit}{ekw} comments from u/{skw}{user.name}{ekw} sorting by {skw}{sorting}{ekw} (limitUsers={skw}{limitUsers}{ekw}, submissionLimit={skw}{submissionLimit}{ekw})"
+            )
+
+        if not await checkSafeRedditor(user):
+            return
+
+        # Comments are only kept while under submissionLimit, so the
+        # listing is not read any further than that
+        method = getattr(user.comments, sorting)
+        page = []
+        async for i in method(limit=limit):
+            page.append(i)
+            if len(page) == PAGE_SIZE:
+                rv = await getPage(page)
+                commentCount += len(rv[1])
+                yield rv
+                page = []
+                if submissionCount >= submissionLimit:
+                    break
+        if page and submissionCount < submissionLimit:
+            rv = await getPage(page)
+            commentCount += len(rv[1])
+            yield rv
+    except PERMANENT_ERRORS as e:
+        logger.warning(f"u/{user} is unavailable ({type(e).__name__})")
+        return
+    except Exception:
+        # Raised so the caller can retry the user instead of treating the
+        # user as finished
+        logger.error(traceback.format_exc())
+        raise
+
+    if verbose:
+        logger.info(f"Received {skw}{commentCount}{ekw} comments for u/{skw}{user.name}")
+        logger.info(
+            f"Received {skw}{len(seen)}{ekw} submission authors for u/{skw}{user.name}"
+        )
+
+
+async def _get_user_comments(user, normalize, **kwargs):
+    commentData, submissionData = [], []
+    try:
+        async for tmpSubmission, tmpComment in iter_user_comments(
+            user, normalize, **kwargs
+        ):
+            submissionData.extend(tmpSubmission)
+            commentData.extend(tmpComment)
+    except Exception:
+        # Already logged, keep what was received
+        pass
+    return tuple(submissionData), tuple(commentData)
+
+
+def get_user_comments(
+    user,
+    normalize,
+    sorting="new",
+    limit=None,
+    limitUsers=None,
+    submissionLimit=10,
+    userID=1,
+    lenUsers=1,
+):
+    """
+    Gets a maximum of 1000 comments from a users profile along
+    with their scores. The author of the submission of each
+    comment will also be supplied.
+
+    Parameters:
+        username    (Redditor)              Username to scrape from
+        normalized  (dict)                  Normalize argument
+        sorting     (str)       ["new"]     Sorting to scrape with
+        limit       (int/None)  [None]      Max comments to scrape
+
+    Returns:
+        (list)
+        [
+            (
+                submissionAuthor (Redditor),
+                ...
+            ),
+            (
+                {
+                    "id": commentID (int),
+                    "comment": commentExample (str),
+                    "score": score (int)
+                },
+                ...
+            )
+        ]
+    """
+    return run(
+        _get_user_comments(
+            user,
+            normalize,
+            sorting=sorting,
+            limit=limit,
+            limitUsers=limitUsers,
+            submissionLimit=submissionLimit,
+        )
+    )
+
+
+def map_user_comments(usernames, normalize, workers=1, **kwargs):
+    """
+    Stream many users from one event loop, keeping at most `workers`
+    users (and so listing requests) in flight at a time. Each user's
+    pages are followed by a None result once that user is finished,
+    preceded by FAILED if the user could not be fetched for now (and
+    should not be counted as finished).
+
+    Parameters:
+        usernames   (iterable/callable)     Usernames to scrape from (see
+                                            functions.pool.stream_bounded
+                                            for callables)
+        normalize   (dict)                  Normalize argument
+        workers     (int)       [1]         Users fetched concurrently
+        lenUsers    (int)                   Number of usernames - 1
+        **kwargs                            Passed to iter_user_comments
+
+    Returns:
+        (generator)
+        (
+            (
+                username (str),
+                (submissionAuthors (tuple), comments (tuple)) / FAILED / None
+            ),
+            ...
+        )
+    """
+    total = kwargs.pop("lenUsers") + 1
+    workers = max(1, workers)
+    take = usernames if callable(usernames) else iter(usernames).__next__
+    if blockNSFW and subredditCache is not None:
+        # Profile NSFW checks of a whole batch of users in one request
+        take = prefetch_batches(
+            usernames, lambda batch: run(prefetch_profiles(batch)), size=INFO_BATCH
+        )
+    counter = itertools.count()
+    chunks = run(new_queue(workers * 2))
+    pending = {}
+
+    async def fetch(i, user):
+        # Each user is fetched with the app with the most quota to spare
+        app = limiter.bind()
+        cancelled = False
+        try:
+            reddit = await get_reddit(app)
+            try:
+                async for chunk in iter_user_comments(
+                    user, normalize, reddit=reddit, **kwargs
+                ):
+                    await chunks.put((i, user, chunk))
+            except Exception:
+                # Already logged by iter_user_comments
+                await chunks.put((i, user, FAILED))
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            limiter.unbind(app)
+            # Any other error is raised to the consumer when it awaits the
+            # task, so the user always ends with None
+            if not cancelled:
+                await chunks.put((i, user, None))
+
+    def submit():
+        try:
+            user = take()
+        except StopIteration:
+            return False
+        if user is None:
+            return False
+        i = next(counter)
+        pending[i] = loop.create_task(fetch(i, user))
+        return True
+
+    try:
+        while len(pending) < workers and submit():
+            pass
+
+        completed = 0
+        while pending:
+            i, user, chunk = run(chunks.get())
+            if chunk is None:
+                # Raises the error of a user that failed outside of
+                # iter_user_comments
+                run(pending.pop(i))
+                completed += 1
+                # The total is unknown while usernames are still coming in
+                if not verbose and not callable(usernames):
+                    progress_bar(completed, total, start="Getting user comments: ")
+            yield user, chunk
+            while len(pending) < workers and submit():
+                pass
+    finally:
+        for task in pending.values():
+            task.cancel()
+        if pending:
+            run(asyncio.gather(*pending.values(), return_exceptions=True))
@@ -192,6 +192,7 @@ def get_post_comments(submission, limit=5000):
                     queue.extend(comment.replies)
                     comments.append(
                         {
+                            "id": int(comment.id, 36),
                             "comment": comment.body,
                             "score": comment.score,
                         }
@@ -253,6 +254,7 @@ def get_user_comments(
             ),
             (
                 {
+                    "id": commentID (int),
                     "comment": commentExample (str),
                     "score": score (int)
                 },
@@ -299,6 +301,7 @@ def get_user_comments(
                             logger.warning(f"Skipping beyond restriction")
                     commentData.append(
                         {
+                            "id": int(i.id, 36),
                             "comment": i.body,
                             "score": normalize_range(
                                 i.score,
@@ -0,0 +1,258 @@
+import asyncio
+import math
+import threading
+import time
+
+
+class BlockedTime:
+    """
+    Wall time during which at least one worker was waiting, so time spent
+    by several workers waiting together is only counted once
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.since = None
+        self.total = 0.0
+
+    def enter(self):
+        with self.lock:
+            if not self.waiting:
+                self.since = time.time()
+            self.waiting += 1
+
+    def leave(self):
+        with self.lock:
+            self.waiting -= 1
+            if not self.waiting:
+                self.total += time.time() - self.since
+
+    @property
+    def seconds(self):
+        with self.lock:
+            return self.total + (time.time() - self.since if self.waiting else 0.0)
+
+    def reset(self):
+        with self.lock:
+            self.total = 0.0
+            if self.waiting:
+                self.since = time.time()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every fetch worker. The refill rate spreads the
+    remaining quota from reddit's X-Ratelimit headers evenly over the time
+    left in the window, and the number of requests allowed in flight is
+    sized from that rate and the observed latency (Little's law), up to
+    maxConcurrency.
+    """
+
+    def __init__(self, maxConcurrency=1):
+        self.cond = threading.Condition()
+        self.maxConcurrency = maxConcurrency
+        self.concurrency = 1
+        self.inFlight = 0
+
+        self.tokens = 1.0
+        self.rate = None  # Tokens per second, unknown until the first response
+        self.remaining = None
+        self.resetAt = None
+        self.updatedAt = time.time()
+        self.latency = None
+
+        self.requests = 0
+        # Time spent waiting is counted by this limiter's clock and by any
+        # clock added by a LimiterPool
+        self.clocks = [BlockedTime()]
+
+    def set_max_concurrency(self, maxConcurrency):
+        with self.cond:
+            self.maxConcurrency = max(1, maxConcurrency)
+            self.concurrency = min(self.concurrency, self.maxConcurrency)
+
+    def __refill(self, now):
+        if self.rate is None:
+            return
+        if self.resetAt is not None and now >= self.resetAt:
+            # The window has reset, allow a burst until headers arrive again
+            self.tokens = max(self.tokens, float(self.concurrency))
+        else:
+            self.tokens = min(
+                self.tokens + (now - self.updatedAt) * self.rate,
+                max(float(self.concurrency), 1.0),
+            )
+        self.updatedAt = now
+
+    def try_acquire(self):
+        """
+        Take a token without blocking
+
+        Returns:
+            (float/None)    0 if acquired, otherwise the seconds to wait
+                            (None when waiting on a request to finish)
+        """
+        with self.cond:
+            if self.inFlight >= self.concurrency:
+                return None
+            now = time.time()
+            self.__refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.inFlight += 1
+                self.requests += 1
+                return 0
+            if not self.rate:
+                return max(self.resetAt - now, 0.01) if self.resetAt else 0.01
+            return (1 - self.tokens) / self.rate
+
+    @property
+    def throttled(self):
+        """Seconds during which at least one worker waited on this limiter"""
+        return self.clocks[0].seconds
+
+    def acquire(self):
+        # Checking and waiting under one hold of the (reentrant) lock, so a
+        # release in between can't notify before this thread is waiting
+        with self.cond:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            for clock in self.clocks:
+                clock.enter()
+            try:
+                while wait != 0:
+                    self.cond.wait(wait)
+                    wait = self.try_acquire()
+            finally:
+                for clock in self.clocks:
+                    clock.leave()
+
+    async def acquire_async(self):
+        wait = self.try_acquire()
+        if wait == 0:
+            return
+        for clock in self.clocks:
+            clock.enter()
+        try:
+            while wait != 0:
+                await asyncio.sleep(wait if wait is not None else 0.01)
+                wait = self.try_acquire()
+        finally:
+            for clock in self.clocks:
+                clock.leave()
+
+    def release(self, headers=None, elapsed=None):
+        with self.cond:
+            self.inFlight -= 1
+            now = time.time()
+            if elapsed is not None:
+                self.latency = (
+                    elapsed
+                    if self.latency is None
+                    else self.latency * 0.8 + elapsed * 0.2
+                )
+
+            if headers is not None and "x-ratelimit-remaining" in headers:
+                self.__refill(now)
+                self.remaining = float(headers["x-ratelimit-remaining"])
+                secondsToReset = max(float(headers["x-ratelimit-reset"]), 1.0)
+                self.resetAt = now + secondsToReset
+                # Requests still in flight will spend quota as well
+                self.rate = max(self.remaining - self.inFlight, 0) / secondsToReset
+                self.tokens = min(self.tokens, max(self.remaining - self.inFlight, 0))
+
+                if self.latency is not None:
+                    self.concurrency = min(
+                        max(math.ceil(self.rate * self.latency) + 1, 1),
+                        self.maxConcurrency,
+                    )
+            elif self.rate is None:
+                # No quota information yet (e.g. the token request), give
+                # the token back so the next request can go ahead
+                self.tokens = min(self.tokens + 1, 1.0)
+
+            self.cond.notify_all()
+
+    def reset_stats(self):
+        with self.cond:
+            self.requests = 0
+        self.clocks[0].reset()
+
+
+class LimiterPool:
+    """
+    One RateLimiter per OAuth app of a credential pool (reddit counts the
+    quota per app). Every user fetch is bound to the app with the most
+    quota to spare per fetch already bound to it. Has the statistics of a
+    single RateLimiter: requests are summed over the apps, throttled time
+    is the wall time during which any app made a worker wait.
+    """
+
+    def __init__(self, size=1):
+        self.limiters = [RateLimiter() for _ in range(max(1, size))]
+        self.clock = BlockedTime()
+        for limiter in self.limiters:
+            limiter.clocks.append(self.clock)
+        self.bound = [0] * len(self.limiters)
+        self.lock = threading.Lock()
+        self.startedAt = time.time()
+
+    def __len__(self):
+        return len(self.limiters)
+
+    def __getitem__(self, i):
+        return self.limiters[i]
+
+    def set_max_concurrency(self, maxConcurrency):
+        # Any app may end up serving every worker while the others wait
+        # for their window to reset
+        for limiter in self.limiters:
+            limiter.set_max_concurrency(maxConcurrency)
+
+    def __spare(self, i):
+        # Apps without a response yet have their whole quota left
+        rate = self.limiters[i].rate
+        return (math.inf if rate is None else rate) / (self.bound[i] + 1), -self.bound[i]
+
+    def bind(self):
+        """
+        Returns:
+            (int)   Index of the app to use, release it with unbind
+        """
+        with self.lock:
+            i = max(range(len(self.limiters)), key=self.__spare)
+            self.bound[i] += 1
+            return i
+
+    def unbind(self, i):
+        with self.lock:
+            self.bound[i] -= 1
+
+    @property
+    def requests(self):
+        return sum(i.requests for i in self.limiters)
+
+    @property
+    def throttled(self):
+        return self.clock.seconds
+
+    def stats(self):
+        """
+        Returns:
+            (list)  [(requests (int), requests per second (float),
+                    throttled seconds (float), quota left (float/None)), ...]
+                    Throttled seconds are wall time, like RateLimiter.throttled
+        """
+        elapsed = max(time.time() - self.startedAt, 0.001)
+        return [
+            (i.requests, i.requests / elapsed, i.throttled, i.remaining)
+            for i in self.limiters
+        ]
+
+    def reset_stats(self):
+        for limiter in self.limiters:
+            limiter.reset_stats()
+        self.clock.reset()
+        self.startedAt = time.time()
@@ -0,0 +1,206 @@
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import prawcore
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+RATELIMIT_HEADERS = ("x-ratelimit-remaining", "x-ratelimit-reset", "x-ratelimit-used")
+TIMEOUT = (5, 16)  # Seconds to connect, seconds between bytes received
+
+
+class PooledSession(requests.Session):
+    """
+    Session shared by every fetch worker, with one kept-alive connection
+    per worker (per host) so requests rarely pay for a new TLS handshake.
+    """
+
+    def __init__(self, poolSize=1):
+        super().__init__()
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+        self.headers["Connection"] = "keep-alive"
+        self.baseline = (0, 0)
+        self.resize(poolSize)
+
+    def resize(self, poolSize):
+        old = self.adapters.get("https://")
+        # Two hosts: www.reddit.com for tokens and oauth.reddit.com for the API
+        self.mount(
+            "https://",
+            HTTPAdapter(pool_connections=2, pool_maxsize=max(1, poolSize)),
+        )
+        if old is not None:
+            old.close()
+        self.baseline = (0, 0)
+
+    def __totals(self):
+        pools = self.adapters["https://"].poolmanager.pools
+        requests = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections += pool.num_connections
+        return requests, connections
+
+    def connection_stats(self):
+        """
+        Returns:
+            (tuple) (requests, new connections) since the last reset
+        """
+        requests, connections = self.__totals()
+        return requests - self.baseline[0], connections - self.baseline[1]
+
+    def reset_stats(self):
+        self.baseline = self.__totals()
+
+
+class LimitedRequestor(prawcore.Requestor):
+    """
+    Requestor which passes every request through a shared RateLimiter.
+
+    The rate limit headers are consumed here and removed from the response,
+    so prawcore's own (per-client, unsynchronised) sleeping does not stack
+    on top of the shared limiter.
+    """
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def send(self, *args, **kwargs):
+        return super().request(*args, **kwargs)
+
+    def request(self, *args, **kwargs):
+        if self.limiter is None:
+            return self.send(*args, **kwargs)
+
+        self.limiter.acquire()
+        start = time.time()
+        response = None
+        try:
+            response = self.send(*args, **kwargs)
+            return response
+        finally:
+            headers = response.headers if response is not None else None
+            self.limiter.release(headers, time.time() - start)
+            if headers is not None:
+                for i in RATELIMIT_HEADERS:
+                    headers.pop(i, None)
+
+
+class ReplayMissError(Exception):
+    pass
+
+
+def exchange_key(method, url, params=None, data=None, **kwargs):
+    """
+    Identify a request by everything that affects its response (but not
+    headers or credentials, so an archive can be replayed without them)
+    """
+    parts = [method.upper(), url]
+    for i in (params, data):
+        if i:
+            items = i.items() if isinstance(i, dict) else i
+            parts.append(urlencode(sorted((str(k), str(v)) for k, v in items)))
+    if kwargs.get("json") is not None:
+        parts.append(json.dumps(kwargs["json"], sort_keys=True))
+    return " ".join(parts)
+
+
+class Archive:
+    """
+    Every HTTP exchange of a run, stored in a sqlite file. Identical
+    requests are told apart by the order they were made in.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.sequence = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS exchanges (
+                key TEXT,
+                seq INTEGER,
+                url TEXT,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                PRIMARY KEY (key, seq)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __next_seq(self, key):
+        seq = self.sequence.get(key, 0)
+        self.sequence[key] = seq + 1
+        return seq
+
+    def record(self, key, response):
+        # The body is stored decoded, so encoding headers no longer apply
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO exchanges VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self.__next_seq(key),
+                    response.url,
+                    response.status_code,
+                    json.dumps(headers),
+                    response.content,
+                ),
+            )
+            self.conn.commit()
+
+    def replay(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT url, status, headers, body FROM exchanges WHERE key = ? AND seq = ?",
+                (key, self.__next_seq(key)),
+            ).fetchone()
+        if row is None:
+            raise ReplayMissError(f"No recorded response for {key}")
+
+        response = requests.Response()
+        response.url, response.status_code = row[0], row[1]
+        response.headers = CaseInsensitiveDict(json.loads(row[2]))
+        response._content = row[3]
+        response.reason = requests.status_codes._codes[row[1]][0].upper()
+        return response
+
+    def close(self):
+        self.conn.close()
+
+
+class RecordingRequestor(LimitedRequestor):
+    """Makes real requests, storing every exchange in an Archive"""
+
+    def __init__(self, *args, archive=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.archive = archive
+
+    def send(self, *args, **kwargs):
+        response = super().send(*args, **kwargs)
+        self.archive.record(exchange_key(*args, **kwargs), response)
+        return response
+
+
+class ReplayRequestor(LimitedRequestor):
+    """Answers every request from an Archive without touching the network"""
+
+    def __init__(self, *args, archive=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.archive = archive
+
+    def send(self, *args, **kwargs):
+        return self.archive.replay(exchange_key(*args, **kwargs))
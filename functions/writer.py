@@ -0,0 +1,231 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+
+class BulkWriter:
+    """
+    Write-behind inserter for one SQLite database. Rows are queued by the
+    producer (blocking once `queueSize` batches are waiting) and inserted
+    by a dedicated thread in large transactions, committed once `batchSize`
+    rows are pending or `flushInterval` seconds have passed.
+
+    Sinks (objects with write(rows) and close()) are given every row that
+    was actually inserted, which needs `existingQuery` to select the keys
+    (the first column) already stored, e.g. "SELECT id FROM data WHERE id IN ({})"
+
+    `encode(conn, rows)`, if given, transforms new rows just before they
+    are inserted (sinks still receive the untransformed rows)
+    """
+
+    def __init__(
+        self,
+        path,
+        query,
+        batchSize=5000,
+        flushInterval=2.0,
+        queueSize=64,
+        synchronous="NORMAL",
+        cacheSize=65536,
+        sinks=(),
+        existingQuery=None,
+        encode=None,
+    ):
+        self.path = path
+        self.query = query
+        self.sinks = list(sinks)
+        self.encode = encode
+        self.existingQuery = existingQuery
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.synchronous = synchronous
+        self.cacheSize = cacheSize
+
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.error = None
+        self.closed = False
+
+        self.rows = 0
+        self.inserted = 0
+        self.busy = 0.0
+        self.transactions = 0
+
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def __connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        # Negative values are in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = {-abs(self.cacheSize)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def __new_rows(self, conn, pending):
+        existing = set()
+        for i in range(0, len(pending), 500):
+            keys = [row[0] for row in pending[i : i + 500]]
+            existing.update(
+                key
+                for (key,) in conn.execute(
+                    self.existingQuery.format(", ".join("?" * len(keys))), keys
+                )
+            )
+        new = []
+        for row in pending:
+            if row[0] not in existing:
+                existing.add(row[0])
+                new.append(row)
+        return new
+
+    def __commit(self, conn, pending):
+        start = time.time()
+        rows = pending
+        with conn:
+            if self.sinks or self.encode:
+                # Only the rows that will be inserted reach the sinks (or
+                # are worth encoding)
+                rows = self.__new_rows(conn, pending)
+            cursor = conn.executemany(
+                self.query, self.encode(conn, rows) if self.encode else rows
+            )
+        for sink in self.sinks:
+            sink.write(rows)
+        self.busy += time.time() - start
+        self.rows += len(pending)
+        # Less than rows when an INSERT OR IGNORE skips duplicates (rows
+        # written by triggers, e.g. the full-text index, are not counted)
+        self.inserted += max(cursor.rowcount, 0)
+        self.transactions += 1
+
+    def __run(self):
+        conn = self.__connect()
+        pending = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+
+                if item is None or isinstance(item, threading.Event):
+                    if pending:
+                        self.__commit(conn, pending)
+                    pending, deadline = [], None
+                    if item is None:
+                        return
+                    item.set()
+                    continue
+
+                pending.extend(item)
+                if pending and deadline is None:
+                    deadline = time.time() + self.flushInterval
+                if len(pending) >= self.batchSize or (
+                    deadline is not None and time.time() >= deadline
+                ):
+                    self.__commit(conn, pending)
+                    pending, deadline = [], None
+        except Exception as e:
+            self.error = e
+            # Release anyone waiting on a flush
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+        finally:
+            conn.close()
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except Exception as e:
+                    self.error = self.error or e
+
+    def __check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, rows):
+        self.__check()
+        if rows:
+            self.queue.put(tuple(rows))
+
+    def flush(self):
+        """Block until every queued row is committed"""
+        self.__check()
+        if self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            while not done.wait(0.1) and self.thread.is_alive():
+                pass
+        self.__check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.__check()
+
+    def rows_per_second(self):
+        return self.rows / self.busy if self.busy else 0.0
+
+    def reset_stats(self):
+        self.rows, self.inserted, self.busy, self.transactions = 0, 0, 0.0, 0
+
+
+class ShardedWriter:
+    """
+    Spreads rows over several BulkWriters (one database file each) by
+    their key (the first column), so the same key always lands in the same
+    shard and every shard commits in parallel. Same interface as BulkWriter.
+    """
+
+    def __init__(self, paths, query, **kwargs):
+        self.writers = [BulkWriter(path, query, **kwargs) for path in paths]
+
+    def write(self, rows):
+        shards = [[] for _ in self.writers]
+        for row in rows:
+            shards[row[0] % len(shards)].append(row)
+        for writer, shard in zip(self.writers, shards):
+            writer.write(shard)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    @property
+    def rows(self):
+        return sum(i.rows for i in self.writers)
+
+    @property
+    def inserted(self):
+        return sum(i.inserted for i in self.writers)
+
+    @property
+    def transactions(self):
+        return sum(i.transactions for i in self.writers)
+
+    def rows_per_second(self):
+        # Shards write at the same time, so their rates add up
+        return sum(i.rows_per_second() for i in self.writers)
+
+    def reset_stats(self):
+        for writer in self.writers:
+            writer.reset_stats()
@@ -1,14 +1,19 @@
 import argparse
+import importlib.util
 import os
+import re
+import subprocess
 import sys
 from colorama import init, Fore, Style
 from pathlib import Path
 import logging
 import traceback
 import time
+from collections import deque
 
 from functions.general import _human_bytes, get_file_handle, handle_time, get_subs
 from functions.formatters import CustomFormatter, CustomCleanFormatter
+from functions.pool import FAILED
 
 
 def build_normalize(normalize):
@@ -33,7 +38,7 @@ def confirm_args():
     global args
     logger.info(f"Setting directory to {Fore.CYAN}{os.path.abspath(args['dir'])}")
     files = [i for i in os.listdir(args["dir"]) if i != "build"]
-    if len(files) > 0:
+    if len(files) > 0 and not args["resume"] and args["worker"] is None:
         if args["noInput"]:
             logger.warning(
                 f"(No input) {Style.RESET_ALL}{args['dir']} has existing files."
@@ -58,6 +63,83 @@ def confirm_args():
     elif args["userCommentLimit"] < 1:
         logger.error(f"userCommentLimit is less than 1 ({args['userCommentLimit']})")
 
+    if args["formatParquet"] or args["parquetIncremental"]:
+        if importlib.util.find_spec("pyarrow") is None:
+            logger.error("formatParquet requires pyarrow (pip install pyarrow)")
+            sys.exit(1)
+
+    if args["resume"] and args["parquetIncremental"]:
+        logger.error("parquetIncremental cannot be used with resume (use formatParquet)")
+        sys.exit(1)
+
+    if args["compressBodies"]:
+        if importlib.util.find_spec("zstandard") is None:
+            logger.error("compressBodies requires zstandard (pip install zstandard)")
+            sys.exit(1)
+
+    if not 0 < args["nearDuplicateThreshold"] < 1:
+        logger.error(
+            f"nearDuplicateThreshold is not between 0 and 1 ({args['nearDuplicateThreshold']})"
+        )
+        sys.exit(1)
+
+    if args["shards"] < 1:
+        logger.error(f"shards is less than 1 ({args['shards']})")
+        sys.exit(1)
+
+    if args["shards"] > 1 and (args["compressBodies"] or args["parquetIncremental"]):
+        logger.error("shards cannot be combined with compressBodies or parquetIncremental")
+        sys.exit(1)
+
+    if args["checkpointEvery"] < 1:
+        logger.error(f"checkpointEvery is less than 1 ({args['checkpointEvery']})")
+        sys.exit(1)
+
+    if args["writeBatch"] < 1:
+        logger.error(f"writeBatch is less than 1 ({args['writeBatch']})")
+        sys.exit(1)
+
+    if args["workers"] < 1:
+        logger.error(f"workers is less than 1 ({args['workers']})")
+        sys.exit(1)
+
+    if args["coordinate"] is not None or args["worker"] is not None:
+        if args["coordinate"] is not None and args["worker"] is not None:
+            logger.error("coordinate and worker cannot be used together")
+            sys.exit(1)
+        if args["coordinate"] is not None and args["coordinate"] < 0:
+            logger.error(f"coordinate is less than 0 ({args['coordinate']})")
+            sys.exit(1)
+        if args["worker"] is not None and not re.fullmatch(r"[\w-]+", args["worker"]):
+            logger.error(f"worker may only contain letters, digits, _ and - ({args['worker']})")
+            sys.exit(1)
+        if (
+            args["shards"] > 1
+            or args["compressBodies"]
+            or args["parquetIncremental"]
+            or args["pipeline"]
+            or args["record"]
+            or args["replay"]
+        ):
+            logger.error(
+                "Distributed crawls cannot be combined with shards, compressBodies, parquetIncremental, pipeline, record or replay"
+            )
+            sys.exit(1)
+        if args["leaseSize"] < 1:
+            logger.error(f"leaseSize is less than 1 ({args['leaseSize']})")
+            sys.exit(1)
+        if args["leaseSeconds"] < 1:
+            logger.error(f"leaseSeconds is less than 1 ({args['leaseSeconds']})")
+            sys.exit(1)
+
+    if (args["record"] or args["replay"]) and args["engine"] != "praw":
+        logger.error("record and replay are only supported by the praw engine")
+        sys.exit(1)
+
+    if args["replay"] and not os.path.isfile(args["replay"]):
+        logger.error(f"Replay archive does not exist ({args['replay']})")
+        sys.exit(1)
+
     if args["normalize"] is not None:
         if args["normalize"][0] > args["normalize"][1]:
             logger.error(
@@ -96,6 +178,7 @@ def creation_process():
         get_post_comments,
         startSubmissions,
         limit=args["postCommentLimit"],
+        requestBudget=args["postRequestBudget"],
     )
     logger.info(f"Got {len(commentUsers)} users")
     logger.info(f"Got {len(comments)} initial comments")
@@ -110,61 +193,392 @@ def creation_process():
         sys.exit(1)
 
     # Dump scraped comments to database
+    if nearDuplicates is not None:
+        comments = nearDuplicates.filter(comments)
     layerHandler.dump_data(comments)
 
     # Dump to layer 1
     layerHandler.dump_build_layer(1, initialUserCollection)
+    layerHandler.finish_stage("creation")
     logger.info(f"{Fore.LIGHTGREEN_EX}Finished building layer 1")
 
 
+def reset_stats():
+    submissionCache.reset_stats()
+    layerHandler.skippedUsers = 0
+    if nearDuplicates is not None:
+        nearDuplicates.reset_stats()
+    limiter.reset_stats()
+    layerHandler.writer.reset_stats()
+    reset_connection_stats()
+
+
+def report_stats(finished, start):
+    end = time.time()
+    logger.info(
+        f"{Fore.LIGHTGREEN_EX}Finished {finished} (Elapsed {round(end-start, 2)}s, throttled {round(limiter.throttled, 2)}s over {limiter.requests} requests)"
+    )
+    logger.info(
+        f"Submission cache: {submissionCache.hits} hits, {submissionCache.misses} misses"
+    )
+    logger.info(
+        f"Skipped {layerHandler.skippedUsers} users that were already queued"
+    )
+    if nearDuplicates is not None:
+        logger.info(
+            f"Dropped {nearDuplicates.dropped} near-duplicate comments of {nearDuplicates.seen}"
+        )
+    writer = layerHandler.writer
+    logger.info(
+        f"Wrote {writer.inserted} rows ({writer.rows - writer.inserted} duplicates skipped) in {writer.transactions} transactions ({round(writer.rows / max(end - start, 0.001))} rows/s, {round(writer.rows_per_second())} rows/s while writing)"
+    )
+    if layerHandler.codec is not None:
+        logger.info(
+            f"Comment bodies compressed {round(layerHandler.codec.ratio(), 2)}x ({_human_bytes(layerHandler.codec.rawBytes)} -> {_human_bytes(layerHandler.codec.storedBytes)} so far)"
+        )
+    if len(limiter) > 1:
+        for i, (requests, rate, throttled, remaining) in enumerate(limiter.stats(), 1):
+            logger.info(
+                f"App {i}: {requests} requests ({round(rate, 2)}/s), throttled {round(throttled, 2)}s{'' if remaining is None else f', {int(remaining)} left in window'}"
+            )
+    requests, connections = connection_stats()
+    if requests:
+        logger.info(
+            f"Connections: {connections} opened for {requests} requests ({round(100 * (1 - connections / requests), 1)}% reused)"
+        )
+
+
+def handle_user_result(layer, result):
+    newUsers, comments = result
+    if args["verbose"]:
+        logger.debug(f"Received {len(newUsers)} users for next layer")
+        logger.debug(f"Received {len(comments)} comments")
+
+    # Add users to the next layer and add to final database
+    layerHandler.dump_build_layer(layer + 1, newUsers)
+    if nearDuplicates is not None:
+        comments = nearDuplicates.filter(comments)
+    layerHandler.dump_data(comments)
+
+
 def process_layer(layer):
     logger.info(
         f"{Fore.LIGHTMAGENTA_EX}Processing layer {layer}... ({get_dump_size()})"
     )
     start = time.time()
+    reset_stats()
 
     # Prepare next layer
     layerHandler.setup_build_layer(layer + 1)
 
-    # Fetch all usernames to scrape
-    usernames = layerHandler.read_build_layer(layer)[: args["userLimit"]]
-    lenUsers = len(usernames) - 1
-
-    # Iterate through all users
-    for i, user in enumerate(usernames):
-        if args["verbose"]:
-            logger.debug(f"Getting {user} comments..")
+    # Fetch all usernames to scrape (users finished by an earlier run are
+    # skipped)
+    usernames = layerHandler.iter_build_layer(
+        layer,
+        limit=args["userLimit"],
+        skipCompleted=True,
+        priority=args["frontier"] == "priority",
+    )
+    lenUsers = (
+        layerHandler.count_build_layer(layer, limit=args["userLimit"])
+        - layerHandler.count_completed(layer)
+        - 1
+    )
 
-        # Scrape all comments, get submission data from x
-        # amount of comments
-        newUsers, comments = get_user_comments(
-            user,
+    # Fetch users concurrently, writing each page of results from this
+    # thread as soon as it arrives
+    completed = []
+    failed = set()
+    try:
+        for user, result in map_user_comments(
+            usernames,
             normalize,
+            workers=args["workers"],
             sorting="hot",
             limit=args["userCommentLimit"],
             limitUsers=args["userLimit"],
             submissionLimit=args["submissionLimit"],
-            userID=i,
             lenUsers=lenUsers,
+        ):
+            if result is FAILED:
+                failed.add(user)
+                continue
+            if result is None:
+                # Failed users are left for a resumed run to retry
+                if user in failed:
+                    continue
+                if args["verbose"]:
+                    logger.info(f"Completed {user}")
+                completed.append(user)
+                if len(completed) >= args["checkpointEvery"]:
+                    layerHandler.checkpoint(layer, completed)
+                    completed = []
+                continue
+
+            handle_user_result(layer, result)
+    finally:
+        # Also on interrupt, so a resumed run starts after these users
+        layerHandler.checkpoint(layer, completed)
+
+    if failed:
+        logger.warning(
+            f"{len(failed)} users of layer {layer} failed, run again with --resume to retry them"
         )
+    else:
+        layerHandler.finish_stage(f"layer{layer}")
+    report_stats(f"processing layer {layer}", start)
+
+
+def process_pipeline():
+    """
+    Crawl every layer from one work queue: users become eligible as soon
+    as they are added to their layer, shallower layers first, so workers
+    never wait for the slowest user of a layer
+    """
+    logger.info(
+        f"{Fore.LIGHTMAGENTA_EX}Processing layers 1-{args['layers']} as a pipeline... ({get_dump_size()})"
+    )
+    start = time.time()
+    reset_stats()
+
+    layers = range(1, args["layers"] + 1)
+    for layer in layers:
+        layerHandler.setup_build_layer(layer + 1)
+
+    cursors = {layer: 0 for layer in layers}  # Last rowid read per layer
+    taken = {layer: 0 for layer in layers}  # Counted towards userLimit
+    ready = deque()
+    inFlight = {}  # Username -> layer (each user is only in one layer)
+
+    def next_user():
+        if not ready:
+            for layer in layers:
+                if layerHandler.stage_finished(f"layer{layer}"):
+                    continue
+                size = 100
+                if args["userLimit"] is not None:
+                    size = min(size, args["userLimit"] - taken[layer])
+                    if size <= 0:
+                        continue
+                rows = layerHandler.take_build_layer(layer, cursors[layer], size)
+                if not rows:
+                    continue
+                cursors[layer] = rows[-1][0]
+                taken[layer] += len(rows)
+                ready.extend((layer, username) for _, username, done in rows if not done)
+                if ready:
+                    break
+        if not ready:
+            return None
+        layer, username = ready.popleft()
+        inFlight[username] = layer
+        return username
+
+    completed = {layer: [] for layer in layers}
+    failed = {layer: set() for layer in layers}
+    try:
+        for user, result in map_user_comments(
+            next_user,
+            normalize,
+            workers=args["workers"],
+            sorting="hot",
+            limit=args["userCommentLimit"],
+            limitUsers=args["userLimit"],
+            submissionLimit=args["submissionLimit"],
+            lenUsers=0,
+        ):
+            layer = inFlight[user]
+            if result is FAILED:
+                failed[layer].add(user)
+                continue
+            if result is None:
+                del inFlight[user]
+                # Failed users are left for a resumed run to retry
+                if user in failed[layer]:
+                    continue
+                if args["verbose"]:
+                    logger.info(f"Completed {user} (layer {layer})")
+                completed[layer].append(user)
+                if len(completed[layer]) >= args["checkpointEvery"]:
+                    layerHandler.checkpoint(layer, completed[layer])
+                    completed[layer] = []
+                continue
+
+            handle_user_result(layer, result)
+    finally:
+        for layer in layers:
+            layerHandler.checkpoint(layer, completed[layer])
+
+    for layer in layers:
+        if failed[layer]:
+            logger.warning(
+                f"{len(failed[layer])} users of layer {layer} failed, run again with --resume to retry them"
+            )
+        else:
+            layerHandler.finish_stage(f"layer{layer}")
+    report_stats(f"processing layers 1-{args['layers']}", start)
 
-        if args["verbose"]:
-            logger.debug(f"Received {len(newUsers)} users for next layer")
-            logger.debug(f"Received {len(comments)} comments")
-            logger.info(f"Completed {user}")
 
-        # Add users to the next layer and add to final database
-        layerHandler.dump_build_layer(layer + 1, newUsers)
-        layerHandler.dump_data(comments)
+def process_leases():
+    """
+    Worker side of a distributed crawl: lease batches of users from the
+    shared build database until every layer is finished. Comments go to
+    this worker's own dump-wN.db, merged by the coordinator at the end.
+    """
+    logger.info(
+        f"{Fore.LIGHTMAGENTA_EX}Worker {args['worker']} processing layers 1-{args['layers']}..."
+    )
+    start = time.time()
+    reset_stats()
+    leases = LeaseQueue(
+        layerHandler.buildDb,
+        args["worker"],
+        leaseSeconds=args["leaseSeconds"],
+        priority=args["frontier"] == "priority",
+    )
 
-    end = time.time()
+    for layer in range(1, args["layers"] + 1):
+        layerHandler.setup_build_layer(layer + 1)
+        ready = deque()
+        held = set()  # Leased by this worker and not completed yet
+        failed = set()
+        state = {"finished": False, "renewed": time.time()}
+
+        def next_user():
+            if not ready:
+                batch = leases.lease(layer, size=args["leaseSize"], limit=args["userLimit"])
+                if batch is None:
+                    state["finished"] = True
+                if not batch:
+                    return None
+                held.update(batch)
+                ready.extend(batch)
+            return ready.popleft()
+
+        while not state["finished"]:
+            completed = []
+            processed = 0
+            try:
+                for user, result in map_user_comments(
+                    next_user,
+                    normalize,
+                    workers=args["workers"],
+                    sorting="hot",
+                    limit=args["userCommentLimit"],
+                    limitUsers=args["userLimit"],
+                    submissionLimit=args["submissionLimit"],
+                    lenUsers=0,
+                ):
+                    if result is FAILED:
+                        # Not renewed, so the lease expires and the user is
+                        # retried by whichever worker leases it next
+                        held.discard(user)
+                        failed.add(user)
+                        continue
+                    if result is not None:
+                        handle_user_result(layer, result)
+                        continue
+                    if user in failed:
+                        failed.discard(user)
+                        continue
+
+                    if args["verbose"]:
+                        logger.info(f"Completed {user} (layer {layer})")
+                    held.discard(user)
+                    processed += 1
+                    completed.append(user)
+                    if len(completed) >= args["checkpointEvery"]:
+                        layerHandler.checkpoint(layer, completed)
+                        leases.complete(layer, completed)
+                        completed = []
+                    # Keep the remaining users of the batch leased
+                    if time.time() - state["renewed"] > args["leaseSeconds"] / 3:
+                        leases.renew(layer, held)
+                        state["renewed"] = time.time()
+            finally:
+                layerHandler.checkpoint(layer, completed)
+                leases.complete(layer, completed)
+
+            if not state["finished"] and not processed:
+                # The rest of the layer is leased by other workers, which
+                # may still add users to it or give up their leases
+                time.sleep(5)
+
+        layerHandler.finish_stage(f"layer{layer}")
+        logger.info(f"{Fore.LIGHTGREEN_EX}Worker {args['worker']} finished layer {layer}")
+
+    leases.close()
+    report_stats(f"worker {args['worker']}", start)
+
+
+def worker_argv():
+    """
+    Command line for a worker process started by the coordinator: the same
+    arguments without --coordinate
+    """
+    argv = []
+    skip = False
+    for i in sys.argv[1:]:
+        name, equals, _ = i.partition("=")
+        if skip:
+            skip = False
+        # Also abbreviated (e.g. --coord), which argparse accepts
+        elif len(name) > 2 and "--coordinate".startswith(name):
+            skip = not equals
+        else:
+            argv.append(i)
+    return [sys.executable, os.path.abspath(sys.argv[0])] + argv
+
+
+def coordinate():
+    """
+    Start the local worker processes and wait until they have finished
+    every layer (workers started by hand on the same directory help out)
+    """
+    start = time.time()
+    layerHandler.close_writer()
+    processes = [
+        subprocess.Popen(worker_argv() + ["--worker", str(i)])
+        for i in range(1, args["coordinate"] + 1)
+    ]
+    logger.info(
+        f"{Fore.LIGHTMAGENTA_EX}Coordinating {len(processes)} local workers for layers 1-{args['layers']}..."
+    )
+
+    layers = range(1, args["layers"] + 1)
+    try:
+        while True:
+            if all(layerHandler.stage_finished(f"layer{i}") for i in layers):
+                break
+            if processes and all(i.poll() is not None for i in processes):
+                break
+            time.sleep(5)
+            logger.debug(
+                f"Completed users: {', '.join(f'layer{i} {layerHandler.count_completed(i)}' for i in layers)} ({get_dump_size()})"
+            )
+    finally:
+        # Workers got the same interrupt and checkpoint before exiting
+        for i in processes:
+            i.wait()
+
+    failed = [i.args[-1] for i in processes if i.returncode != 0]
+    if failed:
+        logger.error(f"Workers {', '.join(failed)} exited with an error")
+    unfinished = [i for i in layers if not layerHandler.stage_finished(f"layer{i}")]
+    if unfinished:
+        logger.error(
+            f"Layers {', '.join(map(str, unfinished))} are unfinished, continue with --resume"
+        )
     logger.info(
-        f"{Fore.LIGHTGREEN_EX}Finished processing layer {layer} (Elapsed {round(end-start, 2)}s)"
+        f"{Fore.LIGHTGREEN_EX}Finished coordinating (Elapsed {round(time.time() - start, 2)}s)"
     )
 
 
 def get_dump_size():
-    return _human_bytes(os.path.getsize(os.path.join(args["dir"], "dump.db")))
+    paths = [layerHandler.dumpDb] + layerHandler.find_shards()
+    # Rows committed by the writer may still be in the write-ahead log
+    paths += [i + "-wal" for i in paths]
+    return _human_bytes(sum(os.path.getsize(i) for i in paths if os.path.isfile(i)))
 
 
 if __name__ == "__main__":
@@ -206,6 +620,14 @@ if __name__ == "__main__":
         help="Maximum comments to scrape from the starting posts",
     )
 
+    parser.add_argument(
+        "--postRequestBudget",
+        "--prb",
+        type=int,
+        default=32,
+        help="Maximum 'load more comments' requests per starting post",
+    )
+
     parser.add_argument(
         "--userCommentLimit",
         "--ucl",
@@ -229,6 +651,140 @@ if __name__ == "__main__":
         help="Maximum submissions to scrape from a user's comment (Heavily affects speed)",
     )
 
+    parser.add_argument(
+        "--submissionCacheSize",
+        type=int,
+        default=100000,
+        help="Submission authors kept in memory (all are kept in build/layers.db)",
+    )
+
+    parser.add_argument(
+        "--writeBatch",
+        type=int,
+        default=5000,
+        help="Rows per dump.db transaction",
+    )
+
+    parser.add_argument(
+        "--writeInterval",
+        type=float,
+        default=2.0,
+        help="Maximum seconds rows wait before being committed",
+    )
+
+    parser.add_argument(
+        "--synchronous",
+        type=str.upper,
+        default="NORMAL",
+        choices=["OFF", "NORMAL", "FULL"],
+        help="SQLite synchronous setting for dump.db",
+    )
+
+    parser.add_argument(
+        "--cacheSize",
+        type=int,
+        default=65536,
+        help="SQLite page cache for dump.db in KiB",
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Write comments to this many dump-N.db files in parallel, merged into dump.db at the end",
+    )
+
+    parser.add_argument(
+        "--mergeShards",
+        action="store_true",
+        help="Only merge dump-N.db files in dir into dump.db, then exit",
+    )
+
+    parser.add_argument(
+        "--frontier",
+        type=str,
+        default="priority",
+        choices=["priority", "fifo"],
+        help="Order users of a layer are scraped in (priority: most referenced first)",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Crawl all layers from one work queue instead of one layer at a time",
+    )
+
+    parser.add_argument(
+        "--coordinate",
+        type=int,
+        default=None,
+        help="Create layer 1, then crawl the layers with this many worker processes",
+    )
+
+    parser.add_argument(
+        "--worker",
+        type=str,
+        default=None,
+        help="Join the distributed crawl in dir as the worker with this id",
+    )
+
+    parser.add_argument(
+        "--leaseSize",
+        type=int,
+        default=50,
+        help="Users a worker leases at a time",
+    )
+
+    parser.add_argument(
+        "--leaseSeconds",
+        type=int,
+        default=600,
+        help="Seconds until users leased by an unresponsive worker are handed out again",
+    )
+
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of users to fetch concurrently",
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="praw",
+        choices=["praw", "async"],
+        help="Scraping backend (praw: threaded, async: asyncpraw event loop)",
+    )
+
+    archiveGroup = parser.add_mutually_exclusive_group()
+    archiveGroup.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="Store every reddit response in this file for later replay",
+    )
+    archiveGroup.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Run offline against responses stored with --record",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the previous run in dir instead of starting over",
+    )
+
+    parser.add_argument(
+        "--checkpointEvery",
+        type=int,
+        default=100,
+        help="Finished users between resume checkpoints",
+    )
+
     parser.add_argument(
         "--verbose",
         "-v",
@@ -278,6 +834,77 @@ if __name__ == "__main__":
         help="Store data in dump.json as well",
     )
 
+    parser.add_argument(
+        "--compressBodies",
+        action="store_true",
+        help="Store comment bodies zstd compressed in dump.db (requires zstandard)",
+    )
+
+    parser.add_argument(
+        "--nearDuplicates",
+        action="store_true",
+        help="Drop comments that are near-duplicates of earlier ones (copypasta, bots)",
+    )
+
+    parser.add_argument(
+        "--nearDuplicateThreshold",
+        type=float,
+        default=0.8,
+        help="Similarity (0-1) from which comments count as near-duplicates",
+    )
+
+    parser.add_argument(
+        "--dedupeDump",
+        action="store_true",
+        help="Only delete near-duplicate comments from dir's dump.db, then exit",
+    )
+
+    parser.add_argument(
+        "--fullText",
+        action="store_true",
+        help="Build a full-text index of comments in dump.db for --search",
+    )
+
+    parser.add_argument(
+        "--search",
+        type=str,
+        default=None,
+        help="Only search the comments in dir's dump.db, then exit",
+    )
+
+    parser.add_argument(
+        "--searchLimit",
+        type=int,
+        default=20,
+        help="Max results returned by --search",
+    )
+
+    parser.add_argument(
+        "--formatParquet",
+        action="store_true",
+        help="Store data in dump.parquet as well (requires pyarrow)",
+    )
+
+    parser.add_argument(
+        "--parquetIncremental",
+        action="store_true",
+        help="Write dump.parquet while scraping instead of after",
+    )
+
+    parser.add_argument(
+        "--jsonFormat",
+        type=str,
+        default="json",
+        choices=["json", "ndjson"],
+        help="Layout of the formatJSON export",
+    )
+
+    parser.add_argument(
+        "--jsonCompress",
+        action="store_true",
+        help="gzip the formatJSON export",
+    )
+
     parser.add_argument(
         "--blockUsers",
         default="",
@@ -362,6 +989,61 @@ if __name__ == "__main__":
 
     # Setup directory and make sure arguments are valid
     setup_directory(args["dir"])
+
+    if args["mergeShards"]:
+        from functions.layerHandling import LayerHandling
+
+        layerHandler = LayerHandling(logger, args["dir"])
+        shards = layerHandler.find_shards()
+        if not shards:
+            logger.error(f"No dump-N.db shards found in {args['dir']}")
+            sys.exit(1)
+        layerHandler.establish_dump_db()
+        layerHandler.setup_dump_table(normalize)
+        rows = layerHandler.merge_shards(shards)
+        logger.info(
+            f"{Fore.LIGHTGREEN_EX}Merged {len(shards)} shards ({rows} new rows) into dump.db: {get_dump_size()}"
+        )
+        sys.exit()
+
+    if args["dedupeDump"]:
+        from functions.layerHandling import LayerHandling
+        from functions.minhash import NearDuplicateFilter
+
+        layerHandler = LayerHandling(logger, args["dir"])
+        if not os.path.isfile(layerHandler.dumpDb):
+            logger.error(f"No dump.db found in {args['dir']}")
+            sys.exit(1)
+        layerHandler.establish_dump_db()
+        layerHandler.load_codec()
+        start = time.time()
+        deleted = layerHandler.dedupe_dump(
+            NearDuplicateFilter(args["nearDuplicateThreshold"])
+        )
+        logger.info(
+            f"{Fore.LIGHTGREEN_EX}Deleted {deleted} near-duplicate comments in {round(time.time() - start, 2)}s: {get_dump_size()}"
+        )
+        sys.exit()
+
+    if args["search"] is not None:
+        from functions.layerHandling import LayerHandling
+
+        layerHandler = LayerHandling(logger, args["dir"])
+        if not os.path.isfile(layerHandler.dumpDb):
+            logger.error(f"No dump.db found in {args['dir']}")
+            sys.exit(1)
+        layerHandler.establish_dump_db()
+        layerHandler.load_codec()
+        if not layerHandler.has_fts():
+            logger.info("Building full-text index (only needed once)..")
+            layerHandler.build_fts()
+        start = time.time()
+        results = layerHandler.search(args["search"], limit=args["searchLimit"])
+        for _, comment, score in results:
+            print(f"{Fore.CYAN}[{score}]{Style.RESET_ALL} {comment}")
+        logger.info(f"{len(results)} results in {round((time.time() - start) * 1000, 2)}ms")
+        sys.exit()
+
     confirm_args()
 
     if args["fileLogging"]:
@@ -377,30 +1059,99 @@ if __name__ == "__main__":
 
     # Import necesssary functions
     # This is delayed to allow parsing arguments to be faster
-    from functions.processing import (
-        users_from_posts,
-        get_post_comments,
-        get_user_comments,
-        set_lp_logger,
-        set_blocked,
-    )
+    if args["engine"] == "async":
+        from functions.processing_async import (
+            users_from_posts,
+            get_post_comments,
+            map_user_comments,
+            set_lp_logger,
+            set_blocked,
+            set_submission_cache,
+            set_subreddit_cache,
+            set_pool_size,
+            connection_stats,
+            reset_connection_stats,
+            limiter,
+            credentials,
+        )
+    else:
+        from functions.processing import (
+            users_from_posts,
+            get_post_comments,
+            map_user_comments,
+            set_lp_logger,
+            set_blocked,
+            set_submission_cache,
+            set_subreddit_cache,
+            setup_reddit,
+            set_pool_size,
+            connection_stats,
+            reset_connection_stats,
+            limiter,
+            credentials,
+        )
+
+        if args["record"] or args["replay"]:
+            setup_reddit(record=args["record"], replay=args["replay"])
+
+    # Replays never reach reddit, everything else needs an app
+    if not credentials and not args["replay"]:
+        logger.error(
+            "No reddit app configured (set client_id and client_secret in functions/.env)"
+        )
+        sys.exit(1)
     from functions.layerHandling import LayerHandling
+    from functions.cache import SubmissionCache, SubredditCache
+    from functions.minhash import NearDuplicateFilter
+    from functions.lease import LeaseQueue
 
     if args["notify"]:
         import winsound
 
-    layerHandler = LayerHandling(logger, args["dir"])
+    # Workers share the build database with the coordinator and each other
+    worker = args["worker"] is not None
+    layerHandler = LayerHandling(logger, args["dir"], shared=worker)
 
     # Setup build database
-    layerHandler.clear_build_db()
+    # Cached lookups would skip requests, so recordings always start cold
+    if not args["resume"] and not worker:
+        layerHandler.clear_build_db(
+            keepCaches=not (args["record"] or args["replay"])
+        )
     layerHandler.establish_build_db()
 
     # Setup dump database
-    layerHandler.clear_dump_db()
+    if not args["resume"] and not worker:
+        layerHandler.clear_dump_db()
     layerHandler.establish_dump_db()
-    layerHandler.setup_dump_table(normalize)
+    layerHandler.setup_dump_table(
+        normalize, compress=args["compressBodies"], shards=args["shards"]
+    )
+    if args["fullText"]:
+        # Compressed bodies can only be indexed once decoded, at the end
+        layerHandler.setup_fts(live=layerHandler.codec is None)
+    layerHandler.start_writer(
+        batchSize=args["writeBatch"],
+        flushInterval=args["writeInterval"],
+        synchronous=args["synchronous"],
+        cacheSize=args["cacheSize"],
+        parquet=args["parquetIncremental"],
+        path=layerHandler.worker_path(args["worker"]) if worker else None,
+    )
+
+    submissionCache = SubmissionCache(
+        layerHandler.buildDb, capacity=args["submissionCacheSize"]
+    )
 
+    set_pool_size(args["workers"])
+    nearDuplicates = (
+        NearDuplicateFilter(args["nearDuplicateThreshold"])
+        if args["nearDuplicates"]
+        else None
+    )
     set_lp_logger(logger, args["verbose"])
+    set_submission_cache(submissionCache)
+    set_subreddit_cache(SubredditCache(layerHandler.buildDb))
     set_blocked(
         args["blockUsers"],
         args["blockNSFW"],
@@ -410,9 +1161,34 @@ if __name__ == "__main__":
         args["restrictSubs"],
     )
 
+    if worker:
+        try:
+            while not layerHandler.stage_finished("creation"):
+                logger.info("Waiting for the coordinator to create layer 1..")
+                time.sleep(5)
+            process_leases()
+        except KeyboardInterrupt:
+            logger.info(f"Worker {args['worker']} stopping (KeyboardInterrupt)")
+        except Exception:
+            logger.critical(
+                f"An unexpected exception occurred in worker {args['worker']} - {traceback.format_exc()}"
+            )
+            sys.exit(1)
+        try:
+            layerHandler.close_writer()
+        except Exception:
+            logger.critical(
+                f"Failed to write to {os.path.basename(layerHandler.worker_path(args['worker']))} - {traceback.format_exc()}"
+            )
+            sys.exit(1)
+        sys.exit()
+
     # Create first layer
     try:
-        creation_process()
+        if layerHandler.stage_finished("creation"):
+            logger.info("Resuming, layer 1 already created")
+        else:
+            creation_process()
     except Exception:
         logger.critical(
             f"An unexpected exception occurred during creation - {traceback.format_exc()}"
@@ -421,8 +1197,19 @@ if __name__ == "__main__":
 
     # Process each layer
     try:
-        for i in range(1, args["layers"] + 1):
-            process_layer(i)
+        if args["coordinate"] is not None:
+            i = f"1-{args['layers']} (distributed)"
+            coordinate()
+        else:
+            if args["pipeline"]:
+                i = f"1-{args['layers']} (pipeline)"
+                process_pipeline()
+            for i in range(1, args["layers"] + 1):
+                if layerHandler.stage_finished(f"layer{i}"):
+                    if not args["pipeline"]:
+                        logger.info(f"Resuming, layer {i} already processed")
+                    continue
+                process_layer(i)
     except KeyboardInterrupt:
         logger.info("Finishing layer processing (KeyboardInterrupt)")
     except Exception:
@@ -431,10 +1218,31 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    try:
+        layerHandler.close_writer()
+        shards = layerHandler.find_shards()
+        if shards:
+            logger.info(f"Merging {len(shards)} shards into dump.db..")
+            layerHandler.merge_shards(shards)
+        if args["fullText"] and layerHandler.codec is not None:
+            logger.info(f"Indexed {layerHandler.build_fts()} comments for search")
+    except Exception:
+        logger.critical(f"Failed to write to dump.db - {traceback.format_exc()}")
+        sys.exit(1)
+
+    if args["formatParquet"] and not args["parquetIncremental"]:
+        try:
+            rows = layerHandler.parquet_dump()
+            logger.info(f"Stored {rows} rows at dump.parquet")
+        except Exception:
+            logger.error(f"Failed to dump Parquet: {traceback.format_exc()}")
+
     if args["formatJSON"]:
         try:
-            layerHandler.json_dump()
-            logger.info("Stored JSON at dump.json")
+            path = layerHandler.json_dump(
+                format=args["jsonFormat"], compress=args["jsonCompress"]
+            )
+            logger.info(f"Stored JSON at {os.path.basename(path)}")
         except Exception:
             logger.error(f"Failed to dump JSON: {traceback.format_exc()}")
 
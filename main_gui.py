@@ -189,7 +189,7 @@ class MainWindow(QMainWindow):
             layerHandler.setup_build_layer(layer + 1)
 
             # Fetch all usernames to scrape
-            usernames = layerHandler.read_build_layer(layer)[: args["userLimit"]]
+            usernames = layerHandler.read_build_layer(layer, limit=args["userLimit"])
             lenUsers = len(usernames) - 1
 
             # Iterate through all users
@@ -265,7 +265,11 @@ class MainWindow(QMainWindow):
             logger.info("Finished building layer 1")
 
         def get_dump_size():
-            return _human_bytes(os.path.getsize(os.path.join(args["dir"], "dump.db")))
+            path = os.path.join(args["dir"], "dump.db")
+            # Rows committed by the writer may still be in the write-ahead log
+            return _human_bytes(
+                sum(os.path.getsize(i) for i in (path, path + "-wal") if os.path.isfile(i))
+            )
 
         def build_normalize(normalize):
             if normalize in (None, False):
@@ -354,6 +358,7 @@ class MainWindow(QMainWindow):
         layerHandler.clear_dump_db()
         layerHandler.establish_dump_db()
         layerHandler.setup_dump_table(normalize)
+        layerHandler.start_writer()
 
         set_lp_logger(logger, args["verbose"])
         set_blocked(
@@ -391,6 +396,11 @@ class MainWindow(QMainWindow):
                 f"An unexpected exception occurred during processing layer {i} - {traceback.format_exc()}"
             )
 
+        try:
+            layerHandler.close_writer()
+        except Exception:
+            self.error(f"Failed to write to dump.db - {traceback.format_exc()}")
+
         if args["formatJSON"]:
             self.status("Formatting json..")
             try: